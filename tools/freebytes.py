@@ -41,58 +41,99 @@ moved in or out of LINEAR or HOME.
 3. Calculate how much of each memory area is occupied
 
 """
-import os, sys, argparse, re
+import os, sys, re, argparse
 
 # Loading linker script #############################################
 
-lsmajorblocksRE = re.compile(r"""([a-zA-Z]+)\s*\{(.*?)\}""")
-
 def ld65parseint(intval):
-    if intval.startswith("$"): return int(intval[1:], 16)
-    return int(intval, 10)
+    return int(intval[1:], 16) if intval[:1] == "$" else int(intval)
+
+def _tokenize_lsfile(text):
+    """Split the body of a linker script into statements.
 
-def parse_nvpset(nvpset):
-    nvpset = [nv.split("=", 1) for nv in nvpset.split(",")]
-    nvpset = {k.strip().lower(): v.strip() for k, v in nvpset}
-    return nvpset
+text -- linker script with comments removed
 
-def parse_lsstatements(contents):
-    segs = [line.strip() for line in contents.split(";")]
-    segs = [line.split(":", 1) for line in segs if line]
-    segs = [(k.strip(), parse_nvpset(v)) for k, v in segs]
-    return segs
+Yield (block name, statement name, {attribute: value, ...}) for each
+statement, such as ("MEMORY", "ZP", {"start": "$10", ...}).
+"""
+    find = text.find
+    blockend = 0
+    while True:
+        blockstart = find("{", blockend)
+        if blockstart < 0: return
+        words = text[blockend:blockstart].split()
+        blockname = words[-1].upper() if words else ""
+        blockend = find("}", blockstart)
+        if blockend < 0: blockend = len(text)
+
+        stmtstart = blockstart + 1
+        while stmtstart < blockend:
+            stmtend = find(";", stmtstart, blockend)
+            if stmtend < 0: stmtend = blockend
+            colon = find(":", stmtstart, stmtend)
+            if colon < 0:
+                if text[stmtstart:stmtend].strip():
+                    raise ValueError("%s: expected name: attributes; got %s"
+                                     % (blockname, text[stmtstart:stmtend]))
+                stmtstart = stmtend + 1
+                continue
+
+            # Walk the comma-separated name=value pairs
+            attrs, nvstart = {}, colon + 1
+            while nvstart < stmtend:
+                nvend = find(",", nvstart, stmtend)
+                if nvend < 0: nvend = stmtend
+                equals = find("=", nvstart, nvend)
+                if equals < 0:
+                    raise ValueError("%s: expected name=value; got %s"
+                                     % (blockname, text[nvstart:nvend]))
+                attrs[text[nvstart:equals].strip().lower()] = \
+                    text[equals + 1:nvend].strip()
+                nvstart = nvend + 1
+            yield blockname, text[stmtstart:colon].strip(), attrs
+            stmtstart = stmtend + 1
+        blockend += 1
+
+_COMMENT_RE = re.compile(r'#[^\n]*')
 
 def ld65_load_linker_script(linkscriptname):
     with open(linkscriptname, "r", encoding="utf-8") as infp:
-        lscontents = [line.split("#", 1)[0].split() for line in infp]
-    lscontents = " ".join(word for line in lscontents for word in line)
-    lscontents = {
-        k.upper(): parse_lsstatements(v)
-        for k, v in lsmajorblocksRE.findall(lscontents)
-    }
-
-    memstartsize = {
-        k: (ld65parseint(v["start"]), ld65parseint(v["size"]))
-        for k, v in lscontents["MEMORY"]
-    }
-    segtomem = {k: v["load"] for k, v in lscontents["SEGMENTS"]}
-    return lscontents, memstartsize, segtomem
+        lscontents = infp.read()
+    lscontents = " ".join(_COMMENT_RE.sub('', lscontents).split())
+
+    # lscontents is of the form {block: [(name, {attr: value}), ...]}
+    blocks, memstartsize, segtomem = {}, {}, {}
+    for blockname, name, attrs in _tokenize_lsfile(lscontents):
+        blocks.setdefault(blockname, []).append((name, attrs))
+        if blockname == "MEMORY":
+            memstartsize[name] = (ld65parseint(attrs["start"]),
+                                  ld65parseint(attrs["size"]))
+        elif blockname == "SEGMENTS":
+            segtomem[name] = attrs["load"]
+    return blocks, memstartsize, segtomem
 
 # Loading map.txt ###################################################
 
 def ld65_map_get_sections(filename):
+    """Split a map file into sections.
+
+Each section begins with a title line followed by a line of at least
+4 hyphens.  Return {lowercase title: [line, ...], ...}.
+"""
+    sections, cursection, prevline = {}, None, ''
     with open(filename, "r", encoding="utf-8") as infp:
-        lines = [line.rstrip() for line in infp]
-    sectbreaks = [
-        i - 1 for i, line in enumerate(lines)
-        if len(line) >= 4 and not line.rstrip('-')
-    ]
-    sections = [lines[i:j] for i, j in zip(sectbreaks, sectbreaks[1:])]
-    sections.append(lines[sectbreaks[-1]:])
-    return {
-        " ".join(s[0].rstrip(':').lower().split()): s[2:]
-        for s in sections
-    }
+        for line in infp:
+            line = line.rstrip()
+            if len(line) >= 4 and line[0] == '-' and line.count('-') == len(line):
+                # The previous line was this section's title, not
+                # the last line of the previous section
+                if cursection: cursection.pop()
+                title = " ".join(prevline.rstrip(':').lower().split())
+                cursection = sections[title] = []
+            elif cursection is not None:
+                cursection.append(line)
+            prevline = line
+    return sections
 
 def parse_argv(argv):
     p = argparse.ArgumentParser(description="Calculates free space by bank in a cc65 project.")
@@ -110,19 +151,19 @@ def main(argv=None):
         line.split() for line in mapsections["name start end size align"] if line
     ]
     segsizes = [(line[0], int(line[3], 16)) for line in seglist]
-    memtosegs = {k: [] for k in memstartsize}
-    memcounts = dict.fromkeys(memstartsize, 0)
+    # meminfo is of the form {memname: [bytes used, [segment, ...]]}
+    meminfo = {k: [0, []] for k in memstartsize}
     for segment, size in segsizes:
-        memname = segtomem[segment]
-        memcounts[memname] += size
-        memtosegs[memname].append(segment)
+        entry = meminfo[segtomem[segment]]
+        entry[0] += size
+        entry[1].append(segment)
 
     ramsize = ramused = romsize = romused = poolsize = poolused = 0
     for m in lscontents["MEMORY"]:
         memname = m[0]
         if memname == 'HEADER': continue
         memstart, memsize = memstartsize[memname]
-        memused = memcounts[memname]
+        memused, memsegs = meminfo[memname]
         ispool = memname.startswith(("LINEAR", "TILEPOOL"))
         if ispool:
             poolsize += memsize
@@ -137,7 +178,7 @@ def main(argv=None):
         print("%-16s %s at $%04X %6d/%6d (%4.1f%%), %6d free"
               % (memname, "RAM" if isram else "ROM", memstart,
                  memused, memsize, memused * 100.0 / memsize, memsize - memused))
-        print("    " + ", ".join(memtosegs[memname]))
+        print("    " + ", ".join(memsegs))
     print("Total RAM: %6d/%6d (%4.1f%%),%6d free"
           % (ramused, ramsize, ramused * 100.0 / ramsize, ramsize - ramused))
     print("Total ROM: %6d/%6d (%4.1f%%),%6d free"
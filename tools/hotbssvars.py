@@ -26,7 +26,7 @@ Changelog:
 2023-08-02 [Pino]
     document dbg format; add ref, type, mod, and importcount
 """
-import sys, os, argparse
+import sys, os, argparse, mmap, pickle, heapq
 from collections import defaultdict
 import ld65dbg
 
@@ -38,68 +38,129 @@ def parse_argv(argv):
     p.add_argument("dbgfile", help="path of debug symbol file")
     p.add_argument("-o", "--output", default='-',
                    help="path of debug symbol file to write")
+    p.add_argument("-n", "--top", type=int, default=None,
+                   help="list only the N most referenced addresses")
+    p.add_argument("--no-cache", dest="use_cache", action="store_false",
+                   help="neither read nor write DBGFILE.pickle, a cache "
+                   "of the parsed debug file that is otherwise kept "
+                   "next to it when its folder is writable")
     return p.parse_args(argv[1:])
 
-def fmt_ref(line, symfile):
-    # given a (file id, line number
-    fileid, linenum = linenums[line]
-    return "%s line %d in %s" % (filenames[fileid], linenum)
+def load_symfile(dbgfile, use_cache=True):
+    """Parse a debug file, or load it from a cache if unchanged.
+
+The cache is dbgfile + ".pickle", stamped with the debug file's
+modification time and size.  It is written only if the debug file's
+folder is writable.  Loading a pickle runs whatever code it names,
+so pass use_cache=False if others can write to that folder.
+"""
+    cache_path = dbgfile + ".pickle"
+    st = os.stat(dbgfile)
+    # The parser's layout version keeps caches from older parsers
+    # from being loaded
+    stamp = (ld65dbg.SYMFILE_VERSION, st.st_mtime_ns, st.st_size)
+    if use_cache:
+        try:
+            with open(cache_path, "rb") as infp:
+                if pickle.load(infp) == stamp:
+                    return pickle.load(infp)
+        except Exception:
+            pass  # a missing or damaged cache just means parsing again
+
+    if st.st_size == 0:
+        # mmap cannot map an empty file
+        symfile = ld65dbg.parse_symfile((), def_lines=False)
+    else:
+        with open(dbgfile, "rb") as infp, \
+             mmap.mmap(infp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            symfile = ld65dbg.parse_symfile(iter(mm.readline, b''),
+                                            def_lines=False)
+    cache_dir = os.path.dirname(os.path.abspath(cache_path))
+    if not use_cache or not os.access(cache_dir, os.W_OK):
+        return symfile  # a read-only folder just means no cache
+    try:
+        with open(cache_path, "wb") as outfp:
+            pickle.dump(stamp, outfp, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(symfile, outfp, pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        # A failed write or an object that pickle can't handle
+        # (PicklingError, TypeError, or AttributeError) just means
+        # no cache, but don't leave a partial one behind
+        try:
+            os.remove(cache_path)
+        except OSError:
+            pass
+    return symfile
 
 def main(argv=None):
     args = parse_argv(argv or sys.argv)
-    with open(args.dbgfile, "r") as infp:
-        symfile = ld65dbg.parse_symfile(infp)
+    symfile = load_symfile(args.dbgfile, args.use_cache)
 
-    code_segid = bss_segid = None
-    for segid, seg in symfile.segs.items():
-        if seg.name == 'CODE': code_segid = segid
-        if seg.name == 'BSS': bss_segid = segid
+    syms, linenums = symfile.syms, symfile.linenums
+    filenames = symfile.filenames
+    code_segid = symfile.seg_by_name.get('CODE')
+    bss_segid = symfile.seg_by_name.get('BSS')
 
     bss_symid_to_code_lines = {}
+    # Symbols at each address, most referenced first, as they are
+    # added while walking sym_refs_desc.  Addresses themselves are
+    # listed by total reference count below.
     bss_val_to_symids = defaultdict(list)
-    sym_refs_desc = sorted(symfile.sym_refs.items(),
-                           key=lambda x: len(x[1]), reverse=True)
-    dupes = defaultdict(set)
-    for symid, refs in sym_refs_desc:
-        sym = symfile.syms[symid]
-        is_bss = sym.seg is not None and symfile.segs[sym.seg].name == 'BSS'
-        if sym.seg == bss_segid:
-            lineids = [
-                lineid for lineid in refs
-                if any(symfile.span_segs[spanid] == code_segid
-                       for spanid in symfile.linenums[lineid].spans)
-            ]
-            if lineids:
-                bss_symid_to_code_lines[symid] = lineids
-                if symid not in bss_val_to_symids[sym.val]:
-                    bss_val_to_symids[sym.val].append(symid)
-
-    val_to_linecount = sorted(
-        ((val, sum(len(bss_symid_to_code_lines[symid]) for symid in symids))
-         for val, symids in bss_val_to_symids.items()),
-        key=lambda x: x[1], reverse=True
+    bss_val_seen = defaultdict(set)
+    # Only BSS symbols are reported, so sort only those
+    sym_refs_get = symfile.sym_refs.get
+    bss_sym_refs = [
+        (symid, sym_refs_get(symid, ()))
+        for symid in symfile.seg_to_symids.get(bss_segid, ())
+    ]
+    sym_refs_desc = sorted(bss_sym_refs, key=lambda x: len(x[1]), reverse=True)
+    # Whether a line is in CODE depends only on the line, so find
+    # all such lines once rather than once per reference
+    code_spans = frozenset(
+        spanid for spanid, segid in symfile.span_segs.items()
+        if segid == code_segid
+    )
+    code_lines = frozenset(
+        lineid for lineid, (_, _, spans) in linenums.items()
+        if not code_spans.isdisjoint(spans)
     )
-    out = []
-    for val, linecount in val_to_linecount:
-        refs_pl = "references" if linecount > 1 else "reference"
-        out.append("$%04X: %d %s\n" % (val, linecount, refs_pl))
-        for symid in bss_val_to_symids[val]:
-            symlines = bss_symid_to_code_lines[symid]
-            refs_pl = "references" if len(symlines) > 1 else "reference"
-            symname = symfile.syms[symid].name
-            out.append("    %s: %d %s\n" % (symname, len(symlines), refs_pl))
-            filelines = [symfile.linenums[i] for i in symlines]
-            filelines = sorted(
-                (symfile.filenames[fl.fileid], fl.linenum)
-                for fl in filelines
-            )
-            out.extend("        %s:%d\n" % row for row in filelines)
-
-    if args.output == '-':
-        sys.stdout.writelines(out)
+    for symid, refs in sym_refs_desc:
+        sym = syms[symid]
+        lineids = [lineid for lineid in refs if lineid in code_lines]
+        if lineids:
+            bss_symid_to_code_lines[symid] = lineids
+            if symid not in bss_val_seen[sym.val]:
+                bss_val_seen[sym.val].add(symid)
+                bss_val_to_symids[sym.val].append(symid)
+
+    counts = [
+        (val, sum(len(bss_symid_to_code_lines[symid]) for symid in symids))
+        for val, symids in bss_val_to_symids.items()
+    ]
+    if args.top is not None:
+        val_to_linecount = heapq.nlargest(args.top, counts, key=lambda x: x[1])
     else:
-        with open(args.output, "w") as outfp:
-            outfp.writelines(out)
+        val_to_linecount = sorted(counts, key=lambda x: x[1], reverse=True)
+    outfp = sys.stdout if args.output == '-' else open(args.output, "w")
+    try:
+        for val, linecount in val_to_linecount:
+            refs_pl = "references" if linecount > 1 else "reference"
+            outfp.write("$%04X: %d %s\n" % (val, linecount, refs_pl))
+            for symid in bss_val_to_symids[val]:
+                symlines = bss_symid_to_code_lines[symid]
+                refs_pl = "references" if len(symlines) > 1 else "reference"
+                outfp.write("    %s: %d %s\n"
+                            % (syms[symid].name, len(symlines), refs_pl))
+                # (filename, line number) tuples sort by themselves,
+                # which is quicker than any key function
+                filelines = [(filenames[fileid], linenum)
+                             for fileid, linenum, _
+                             in map(linenums.__getitem__, symlines)]
+                filelines.sort()
+                outfp.writelines("        %s:%d\n" % row for row in filelines)
+    finally:
+        if outfp is not sys.stdout:
+            outfp.close()
 
 if __name__=='__main__':
     if 'idlelib' in sys.modules:
@@ -26,6 +26,7 @@ Changelog:
     document format; add ref, type, mod, and importcount
 """
 from collections import defaultdict, namedtuple
+from sys import intern
 
 # ld65 debug file structure #########################################
 #
@@ -89,21 +90,41 @@ from collections import defaultdict, namedtuple
 # Keys in a "type" entry
 # id and val, where val appears to be some hex bitfield
 
-def parse_nvp_line(line):
-    line = line.rstrip().split("\t", 1)
-    symtype = line[0]
-    props = (dict(tuple(item.split("=", 1)) for item in line[1].split(","))
-             if len(line) > 1
-             else {})
-    return symtype, props
+def nvp_get(tail, key, default=None):
+    """Find one value among the name=value pairs of a debug file line.
 
-SymFile = namedtuple("DefDicts", [
+tail -- the part of a line after the tab, such as b"id=0,seg=1,start=0"
+key -- a name followed by "=", such as b"seg="
+
+Return the value as bytes, or default if key is absent.  Quoted values
+such as names keep their quotation marks and may contain commas.
+tail may end with a newline, which is removed from the last value.
+"""
+    if tail.startswith(key):
+        start = len(key)
+    else:
+        # Look for the comma before the key so that "size=" does not
+        # match the end of "addrsize="
+        start = tail.find(b"," + key)
+        if start < 0: return default
+        start += len(key) + 1
+    if tail.startswith(b'"', start):
+        end = tail.find(b'"', start + 1) + 1
+    else:
+        end = tail.find(b",", start)
+    return tail[start:end] if end > 0 else tail[start:].rstrip()
+
+# Bump this when SymFile or its records change, so that programs
+# that cache a parsed SymFile do not load one from an older parser
+SYMFILE_VERSION = 6
+
+SymFile = namedtuple("SymFile", [
     'filenames', 'linenums', 'syms', 'sym_refs', 'span_segs', 'segs',
-    'scopes', 'modules', 'importcount'
-])
-FileLine = namedtuple("FileLine", [
-    'fileid', 'linenum', 'spans'
+    'scopes', 'modules', 'importcount', 'seg_by_name', 'seg_to_symids'
 ])
+
+# Line records, the most numerous, are plain tuples
+# (fileid, line number, spanids).
 Segment = namedtuple("Segment", [
     "name", "start", "size", "ooffs"
 ])
@@ -117,9 +138,20 @@ TranslationUnit = namedtuple("TranslationUnit", [
     "name", "fileid"
 ])
 
-def parse_symfile(lines):
+def parse_symfile(lines, def_lines=True):
+    """Parse an ld65 debug file.
+
+lines -- iterable of bytes, such as a file opened in binary mode
+    or iter(mmap.readline, b'')
+def_lines -- if false, leave each Sym's def_lines as None instead
+    of parsing them, for callers that use only references
+
+Return a SymFile.
+"""
+    get = nvp_get
+    parse_defs = def_lines
     filenames = {}  # fileid -> str
-    linenums = {}  # lineid -> (fileid, line number, spanid)
+    linenums = {}  # lineid -> (fileid, line number, spanids)
     syms = {}
     sym_refs = defaultdict(set)  # symid -> lineids
     # Each .segment creates a "span" (or "section fragment" as RGBASM
@@ -127,67 +159,108 @@ def parse_symfile(lines):
     # to form a segment.
     span_segs = {}  # spanid to segid
     segs = {}  # segid to Segment
+    seg_by_name = {}  # segment name to segid
+    seg_to_symids = defaultdict(list)  # segid to symids, in file order
     scopes = {}
     mods = {}
     importcount = defaultdict(int)
 
+    # Fields such as file, line, scope, and seg repeat a few small
+    # numbers across many records, and looking up the bytes in a dict
+    # is quicker than converting them again.  IDs are not repeated,
+    # so they are not worth caching.
+    int_cache, int0_cache = {}, {}
+    def to_int(s):
+        try:
+            return int_cache[s]
+        except KeyError:
+            value = int_cache[s] = int(s)
+            return value
+    def to_int0(s):
+        try:
+            return int0_cache[s]
+        except KeyError:
+            value = int0_cache[s] = int(s, 0)
+            return value
+
+    # Each record type reads only the keys it uses from the tail
+    # rather than building a dict of all keys.  ld65 always puts
+    # names in quotation marks, so slice them off with [1:-1].
+    # Strings repeated across many records, such as symbol types,
+    # are interned so that they are stored once and compare quickly.
     for line in lines:
-        symtype, props = parse_nvp_line(line)
-        if symtype == 'file':
-            filenames[int(props['id'])] = props['name'].strip('"')
-        elif symtype == 'line':
-            linenums[int(props['id'])] = FileLine(
-                int(props['file']), int(props['line']),
-                [int(x) for x in props['span'].split("+")]
-                if 'span' in props
+        symtype, _, tail = line.partition(b"\t")
+        if symtype == b'file':
+            name = intern(get(tail, b'name=')[1:-1].decode())
+            filenames[int(get(tail, b'id='))] = name
+        elif symtype == b'line':
+            spans = get(tail, b'span=')
+            linenums[int(get(tail, b'id='))] = (
+                to_int(get(tail, b'file=')), to_int(get(tail, b'line=')),
+                list(map(int, spans.split(b"+")))
+                if spans is not None
                 else ()
             )
-        elif symtype == 'seg':
-            segs[int(props['id'])] = Segment(
-                props['name'].strip('"'), 
-                int(props['start'], 0), int(props['size'], 0),
-                int(props['ooffs'], 0) if 'ooffs' in props else None
+        elif symtype == b'seg':
+            ooffs = get(tail, b'ooffs=')
+            segid = int(get(tail, b'id='))
+            name = intern(get(tail, b'name=')[1:-1].decode())
+            seg_by_name[name] = segid
+            segs[segid] = Segment(
+                name,
+                int(get(tail, b'start='), 0), int(get(tail, b'size='), 0),
+                int(ooffs, 0) if ooffs is not None else None
             )
-        elif symtype == 'span':
-            span_segs[int(props['id'])] = int(props['seg'])
-        elif symtype == 'sym':
-            name = props['name'].strip('"')
-            symtype = props['type']
-            if symtype == 'imp':
+        elif symtype == b'span':
+            span_segs[int(get(tail, b'id='))] = to_int(get(tail, b'seg='))
+        elif symtype == b'sym':
+            name = get(tail, b'name=')[1:-1].decode()
+            symtype = get(tail, b'type=')
+            # Parse the reference list once for both sym_refs and Sym
+            refs = get(tail, b'ref=')
+            ref_lines = list(map(int, refs.split(b"+"))) if refs else ()
+            if symtype == b'imp':
                 importcount[name] += 1
-                try:
-                    symid = int(props['exp'])
-                except KeyError:
+                symid = get(tail, b'exp=')
+                if symid is None:
                     continue  # unused __SIZE__ label of define=yes segment
+                symid = int(symid)
             else:
-                symid = int(props['id'])
-                value = int(props["val"], base=0) if "val" in props else None
-                scope = int(props['scope']) if 'scope' in props else None
-                seg = int(props['seg']) if 'seg' in props else None
-                size = int(props['size']) if 'size' in props else None
-                def_lines = [int(x) for x in props["def"].split("+")]
+                symid = int(get(tail, b'id='))
+                value = get(tail, b'val=')
+                value = to_int0(value) if value is not None else None
+                scope = get(tail, b'scope=')
+                scope = to_int(scope) if scope is not None else None
+                seg = get(tail, b'seg=')
+                if seg is not None:
+                    seg = to_int(seg)
+                    seg_to_symids[seg].append(symid)
+                size = get(tail, b'size=')
+                size = to_int(size) if size is not None else None
                 # Multiple def lines occur when macro uses .local or .scope
-                ref_lines = props.get('ref')
-                ref_lines = [int(x) for x in ref_lines.split("+")] if ref_lines else ()
+                def_lines = (list(map(int, get(tail, b'def=').split(b"+")))
+                             if parse_defs
+                             else None)
                 syms[symid] = Sym(name, value, scope, seg,
-                                  def_lines, ref_lines, size, symtype)
-            refs = props.get('ref', '')
-            if refs: sym_refs[symid].update(int(x) for x in refs.split("+"))
-        elif symtype == 'scope':
-            if props.get('type') == 'struct': continue
-            scopeid = int(props['id'])
-            name = props['name'].strip('"')
-            parent = int(props['parent']) if 'parent' in props else None
-            spans = props.get('span', '')
+                                  def_lines, ref_lines, size,
+                                  intern(symtype.decode()))
+            if ref_lines: sym_refs[symid].update(ref_lines)
+        elif symtype == b'scope':
+            if get(tail, b'type=') == b'struct': continue
+            scopeid = int(get(tail, b'id='))
+            name = get(tail, b'name=')[1:-1].decode()
+            parent = get(tail, b'parent=')
+            parent = to_int(parent) if parent is not None else None
+            spans = get(tail, b'span=', b'')
             # empty spans means a scope containing no bytes
-            spans = [int(x) for x in spans.split('+')] if spans else ()
-            mod = int(props['mod'])
+            spans = list(map(int, spans.split(b'+'))) if spans else ()
+            mod = to_int(get(tail, b'mod='))
             scopes[scopeid] = Scope(name, parent, spans, mod)
-        elif symtype == 'mod':  # a translation unit
-            modid = int(props['id'])
-            name = props['name'].strip('"')
-            toplevelfile = int(props['file'])
+        elif symtype == b'mod':  # a translation unit
+            modid = int(get(tail, b'id='))
+            name = get(tail, b'name=')[1:-1].decode()
+            toplevelfile = int(get(tail, b'file='))
             mods[modid] = TranslationUnit(name, toplevelfile)
 
     return SymFile(filenames, linenums, syms, sym_refs, span_segs, segs,
-                   scopes, mods, importcount)
+                   scopes, mods, importcount, seg_by_name, seg_to_symids)
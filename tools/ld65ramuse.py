@@ -18,20 +18,7 @@ limitations under the License.
 """
 import os, sys
 from collections import defaultdict
-
-def ld65_map_get_sections(filename):
-    with open(filename, "r", encoding="utf-8") as infp:
-        lines = [line.rstrip() for line in infp]
-    sectbreaks = [
-        i - 1 for i, line in enumerate(lines)
-        if len(line) >= 4 and not line.rstrip('-')
-    ]
-    sections = [lines[i:j] for i, j in zip(sectbreaks, sectbreaks[1:])]
-    sections.append(lines[sectbreaks[-1]:])
-    return {
-        s[0].rstrip(':').lower(): s[2:]
-        for s in sections
-    }
+from freebytes import ld65_map_get_sections
 
 def ld65_parse_modules_list(modules_list):
     module = None
@@ -50,17 +50,24 @@ import os, sys, argparse
 from PIL import Image
 
 def bytestotile(pxdata, width, x, y):
-    rows = [pxdata[p:p + 8]
+    # Read each row of 8 pixels as one 64-bit integer, one pixel per
+    # byte.  Masking keeps bit p of each pixel, and the multiply adds
+    # shifted copies such that the top byte collects pixel 0 in bit 7
+    # through pixel 7 in bit 0.
+    rows = [int.from_bytes(pxdata[p:p + 8], "big")
             for p in range(y * width + x, (y + 8) * width + x, width)]
     d1 = bytes(
-        reduce(bitor, (((row[x] >> p) & 1) << (7 - x) for x in range(8)))
+        (((row >> p) & 0x0101010101010101) * 0x0102040810204080 >> 56) & 0xFF
         for p in (0, 1)
         for row in rows
     )
     return d1
 
-def bmptochr_colmajor(im):
-    """Convert an indexed image to NES tiles, in rows top to bottom"""
+def bmptochr_colmajor_nonp(im):
+    """Convert an indexed image to NES tiles, in columns left to right
+
+(Fallback for when NumPy is not available)
+"""
     pxdata, w = im.tobytes(), im.size[0]
     return [
         bytestotile(pxdata, w, x, y)
@@ -80,23 +87,31 @@ def bmptochr_rowmajor_nonp(im):
         for x in range(0, w, 8)
     ]
 
-# For the common case
-def bmptochr_rowmajor(im):
-    """Convert an indexed image to NES tiles, in rows top to bottom
+def bmptochr_numpy(im, colmajor=False):
+    """Convert an indexed image to NES tiles using NumPy
+
+im -- an indexed PIL image, or a 2D array of its pixels
+colmajor -- if true, order tiles in columns left to right instead of
+    rows top to bottom
+
+Raise ImportError if NumPy is not available.
 
 By Vanadium#6231 in the gbadev Discord server, 2023-01-18
 License: "I consider it too short to be copyrightable; I disclaim copyright"
 """
-    try:
-        import numpy as np
-    except ImportError:
-        return bmptochr_rowmajor_nonp(im)
-    # Convert to an array of 8x8 tiles of pixel data.
-    pixels = np.array(im)
+    import numpy as np
+
+    # Convert to an array of 8x8 tiles of pixel data.  Viewing the
+    # bytes that tobytes() returns avoids a second image-sized copy.
+    if isinstance(im, np.ndarray):
+        pixels = im
+    else:
+        width, height = im.size
+        pixels = np.frombuffer(im.tobytes(), np.uint8).reshape(height, width)
     height, width = pixels.shape
-    tiles = (pixels.reshape(height//8, 8, width//8, 8)
-             .swapaxes(1, 2)
-             .reshape(-1, 8, 8))
+    tiles = pixels.reshape(height//8, 8, width//8, 8)
+    tiles = (tiles.transpose(2, 0, 1, 3) if colmajor
+             else tiles.swapaxes(1, 2)).reshape(-1, 8, 8)
 
     # Pack into NES format.
     bits = tiles[:,None] >> np.array([0, 1], np.uint8)[None,:,None,None]
@@ -104,6 +119,21 @@ License: "I consider it too short to be copyrightable; I disclaim copyright"
     out = np.packbits(bits, axis=3).tobytes()
     return [out[x:x+16] for x in range(0, len(out), 16)]
 
+def bmptochr_colmajor(im):
+    """Convert an indexed image to NES tiles, in columns left to right"""
+    try:
+        return bmptochr_numpy(im, colmajor=True)
+    except ImportError:
+        return bmptochr_colmajor_nonp(im)
+
+# For the common case
+def bmptochr_rowmajor(im):
+    """Convert an indexed image to NES tiles, in rows top to bottom"""
+    try:
+        return bmptochr_numpy(im)
+    except ImportError:
+        return bmptochr_rowmajor_nonp(im)
+
 def load_fix_tiles(filename, colmajor=False):
     """Load fix tiles from a file.
 
@@ -192,24 +222,16 @@ class StripeFileParser(object):
             return
         words = line.split()
         try:
-            if words[0] == 'stripe':
-                return self.append_stripe(words)
-            if words[0] == 'dest':
-                return self.append_dest(words)
-            if words[0] == 'hrect':
-                return self.append_hrect(words)
-            if words[0] == 'vrect':
-                return self.append_vrect(words)
-            if words[0] == 'rect':
-                return self.append_rect(words)
-            if words[0] == 'fallthrough':
-                return self.append_fallthrough()
+            handler = self.appendhandlers[words[0]]
+        except KeyError:
+            self.errmsgs.append("%d: warning: unrecognized keyword %s"
+                                % (self.linenum, words[0]))
+            return
+        try:
+            handler(self, words)
         except Exception as e:
             self.errmsgs.append("%d: %s" % (self.linenum, e))
             self.num_errs += 1
-            return
-        self.errmsgs.append("%d: warning: unrecognized keyword %s"
-                            % (self.linenum, words[0]))
 
     def append_stripe(self, words):
         stripename = words[1]
@@ -245,16 +267,32 @@ class StripeFileParser(object):
             raise ValueError("coordinate must be multiples of 8 pixels")
         self.stripes[-1][1:3] = xy
 
-    def append_fallthrough(self):
+    def append_fallthrough(self, words):
         self.stripes[-1][4] = True
 
-def extract_stripe(tiles, destx, desty, rects):
+    appendhandlers = {
+        'stripe': append_stripe,
+        'dest': append_dest,
+        'hrect': append_hrect,
+        'vrect': append_vrect,
+        'rect': append_rect,
+        'fallthrough': append_fallthrough,
+    }
+
+def extract_stripe(tiles, destx, desty, rects, columns=None):
     """Extract a Stripe Image cel from an image.
 
+tiles -- a list of rows of tiles
+columns -- the same tiles as a list of columns, such as
+    list(zip(*tiles)); pass this when extracting many cels from
+    one image so that it need not be recomputed
+
 Return a list in the form
 [(x tile pos, y tile pos, NSTRIPE_DOWN, [tile, ...]), ...]
 """
     if not rects: return []
+    if columns is None and any(x[0] == 'vrect' for x in rects):
+        columns = list(zip(*tiles))
     srcleft = min(x[1] for x in rects)
     srctop = min(x[2] for x in rects)
     destx, desty = (destx - srcleft) >> 3, (desty - srctop) >> 3
@@ -276,18 +314,22 @@ Return a list in the form
         elif direction == 'vrect':
             for x in range(l, l + w):
                 out.append((destx + x, desty + t, NSTRIPE_DOWN,
-                            [tiles[y][x] for y in range(t, t + h)]))
+                            columns[x][t:t + h]))
     return out
                 
+# Decimal strings of all byte values, quicker to look up than str()
+_BYTE_STRS = [str(i) for i in range(256)]
+
 def ca65_bytearray(s):
-    s = ['  .byte ' + ','.join(str(ch) for ch in s[i:i + 16])
-         for i in range(0, len(s), 16)]
-    return '\n'.join(s)
+    """Format a bytes-like object as ca65 .byte lines"""
+    s = list(map(_BYTE_STRS.__getitem__, s))
+    return '\n'.join('  .byte ' + ','.join(s[i:i + 16])
+                     for i in range(0, len(s), 16))
 
 def ca65_addrarray(s):
-    s = ['  .addr ' + ','.join(str(ch) for ch in s[i:i + 4])
-         for i in range(0, len(s), 4)]
-    return '\n'.join(s)
+    s = list(map(str, s))
+    return '\n'.join('  .addr ' + ','.join(s[i:i + 4])
+                     for i in range(0, len(s), 4))
 
 def main(argv=None):
     args = parse_argv(argv or sys.argv)
@@ -332,31 +374,60 @@ def main(argv=None):
     impitch = im.size[0] // 8
     tiles = bmptochr_rowmajor(im)
     im.close()
+
+    # Hash each tile's bytes once, and work with tile IDs from here on.
+    # id_to_tilenum is filled in as cels use each tile.
+    tileids = {}
+    tiles = [tileids.setdefault(t, len(tileids)) for t in tiles]
+    id_to_tile = list(tileids)
+    id_to_tilenum = [all_extra_tiles.get(t) for t in id_to_tile]
+    del tileids
     tiles = [tiles[i:i + impitch] for i in range(0, len(tiles), impitch)]
+    columns = list(zip(*tiles))
 
     # Extract stripes from the image
+    rawstripedatas = [
+        extract_stripe(tiles, destx, desty, rects, columns)
+        for stripename, destx, desty, rects, fallthrough in parsed.stripes
+    ]
+
+    # Number tiles not already numbered in order of first use
+    used_ids = dict.fromkeys(
+        tileid
+        for rawstripedata in rawstripedatas
+        for _, _, _, stripetiles in rawstripedata
+        for tileid in stripetiles
+    )
+    next_tilenum = len(itiles) + args.base_tile
+    for tileid in used_ids:
+        if id_to_tilenum[tileid] is not None: continue
+        tile = id_to_tile[tileid]
+        tilenum = itiles.get(tile)
+        if tilenum is None:
+            tilenum = itiles[tile] = next_tilenum
+            next_tilenum += 1
+        id_to_tilenum[tileid] = tilenum
+    del used_ids
+    tilenum_of_id = id_to_tilenum.__getitem__
+
     stripedatas = []
-    for stripename, destx, desty, rects, fallthrough in parsed.stripes:
-        rawstripedata = extract_stripe(tiles, destx, desty, rects)
+    for stripe, rawstripedata in zip(parsed.stripes, rawstripedatas):
+        stripename, fallthrough = stripe[0], stripe[4]
         stripedata = bytearray()
         for x, y, direction, stripetiles in rawstripedata:
             addr = 0x2000 + 32 * (y % 30) + (x % 32)
             direction |= len(stripetiles) - 1
 
-            tilenums = []
-            for tile in stripetiles:
-                try:
-                    tile = all_extra_tiles[tile]
-                except KeyError:
-                    tile = itiles.setdefault(tile, len(itiles) + args.base_tile)
-                tilenums.append(tile)
-            if (len(tilenums) > 1
-                and all(x == tilenums[0] for x in tilenums)):
+            tilenums = list(map(tilenum_of_id, stripetiles))
+            # Comparing the ends first rejects most non-runs cheaply
+            if (len(tilenums) > 1 and tilenums[0] == tilenums[-1]
+                and tilenums.count(tilenums[0]) == len(tilenums)):
                 direction |= NSTRIPE_RUN
                 del tilenums[1:]
-            row = bytearray([addr >> 8, addr & 0xFF, direction])
-            row.extend(tilenums)
-            stripedata.extend(row)
+            stripedata.append(addr >> 8)
+            stripedata.append(addr & 0xFF)
+            stripedata.append(direction)
+            stripedata.extend(tilenums)
         if not fallthrough:
             stripedata.append(0xFF)
         stripedatas.append((stripename, stripedata))
@@ -386,8 +457,9 @@ def main(argv=None):
         for sn, sd in stripedatas:
             lines.append("NSTRIPE_%s:" % sn)
             lines.append(ca65_bytearray(sd))
+        lines.append('')
         with open(args.ASMFILE, "w", encoding="utf-8") as outfp:
-            outfp.writelines(x + "\n" for x in lines)
+            outfp.write("\n".join(lines))
     else:
         print(sumline)
     
@@ -27,45 +27,9 @@ limitations under the License.
    decreasing algorithm
 4. write out the SEGMENT entries
 """
-import os, sys, re, argparse, subprocess, bisect
+import os, sys, argparse, subprocess, bisect
 from collections import defaultdict
-
-# Loading linker script #############################################
-
-# this is copied from freebytes.py
-
-lsmajorblocksRE = re.compile(r"""([a-zA-Z]+)\s*\{(.*?)\}""")
-
-def ld65parseint(intval):
-    if intval.startswith("$"): return int(intval[1:], 16)
-    return int(intval, 10)
-
-def parse_nvpset(nvpset):
-    nvpset = [nv.split("=", 1) for nv in nvpset.split(",")]
-    nvpset = {k.strip().lower(): v.strip() for k, v in nvpset}
-    return nvpset
-
-def parse_lsstatements(contents):
-    segs = [line.strip() for line in contents.split(";")]
-    segs = [line.split(":", 1) for line in segs if line]
-    segs = [(k.strip(), parse_nvpset(v)) for k, v in segs]
-    return segs
-
-def ld65_load_linker_script(linkscriptname):
-    with open(linkscriptname, "r", encoding="utf-8") as infp:
-        lscontents = [line.split("#", 1)[0].split() for line in infp]
-    lscontents = " ".join(word for line in lscontents for word in line)
-    lscontents = {
-        k.upper(): parse_lsstatements(v)
-        for k, v in lsmajorblocksRE.findall(lscontents)
-    }
-
-    memstartsize = {
-        k: (ld65parseint(v["start"]), ld65parseint(v["size"]))
-        for k, v in lscontents["MEMORY"]
-    }
-    segtomem = {k: v["load"] for k, v in lscontents["SEGMENTS"]}
-    return lscontents, memstartsize, segtomem
+from freebytes import ld65_load_linker_script
 
 # Measuring segments ################################################
 
@@ -1,10 +1,20 @@
 #!/usr/bin/env python3
-import os, sys, argparse
+import os, sys, stat, argparse, shutil
 from PIL import Image
-from pilbmp2nes import pilbmp2chr, formatTilePlanar
 
-def format_1bpp(tile):
-    return formatTilePlanar(tile, "0")
+def bitrows(im):
+    """Convert a mode 1 image to one int per row, leftmost pixel first."""
+    w, h = im.size
+    rowbytes = (w + 7) // 8
+    data, pad = im.tobytes(), rowbytes * 8 - w
+    return [int.from_bytes(data[i:i + rowbytes], "big") >> pad
+            for i in range(0, rowbytes * h, rowbytes)]
+
+def bitrows_to_1bpp(rows, width=128):
+    """Convert rows of an 8-pixel-tall strip to 1bpp tiles."""
+    rowbytes = width // 8
+    data = b"".join(row.to_bytes(rowbytes, "big") for row in rows)
+    return b"".join(data[i::rowbytes] for i in range(rowbytes))
 
 def parseintorhex(s):
     """Parse an integer that uses $ or 0x for base sixteen or none for base ten"""
@@ -56,32 +66,67 @@ def main(argv=None):
               % args.template.size, file=sys.stderr)
     number, last_number = args.number, args.through
     if last_number is None: last_number = number
-    romdata = bytearray(args.romfile.read())
-    args.romfile.close()
+    # Each ROM differs from the input only in the serial number, so
+    # let the OS copy the input rather than reading it into memory.
+    # Standard input or a pipe can't be copied by name, so read that.
+    romfp = args.romfile
+    if (romfp is not sys.stdin.buffer
+            and stat.S_ISREG(os.fstat(romfp.fileno()).st_mode)):
+        romfilename, romdata = romfp.name, None
+    else:
+        romfilename, romdata = None, romfp.read()
+    romfp.close()
     BANKSIZE = 0x2000
     HEADERSIZE = 0x10
     destaddr = (args.address % BANKSIZE) + (args.bank * BANKSIZE) + HEADERSIZE
 
+    # Convert the template and cut out the digits once for all numbers.
+    # Each row of pixels is an int whose most significant bit is the
+    # left side, so that pasting a digit is a shift and a mask.
+    template = args.template.convert("1")
+    digit_width = args.digit_width
+    background = bitrows(template.crop((0, 0, 128, 8)))
+    digit_rows = [
+        bitrows(template.crop((srcleft, 8, srcleft + digit_width, 16)))
+        for srcleft in range(0, 10 * digit_width, digit_width)
+    ]
+    digit_mask, row_mask = (1 << digit_width) - 1, (1 << 128) - 1
+
+    shifts = []
     while number <= last_number:
-        im = args.template.convert("1")
+        rows = list(background)
         digits = [ord(x) - ord('0') for x in str(number)]
-        left = args.x
-        if args.right: left -= len(digits) * args.digit_width
-        for d in digits:
-            srcleft = d * args.digit_width
-            digit = im.crop((srcleft, 8, srcleft + args.digit_width, 16))
-            im.paste(digit, (left, 0))
-            left += args.digit_width
-        chrdata = pilbmp2chr(im.crop((0, 0, 128, 8)), formatTile=format_1bpp)
-        chrdata = b''.join(chrdata)
+        # Digit positions change only when the number of digits does
+        if len(digits) != len(shifts):
+            left = args.x
+            if args.right: left -= len(digits) * digit_width
+            shifts = [128 - x - digit_width for x in
+                      range(left, left + len(digits) * digit_width,
+                            digit_width)]
+        for shift, d in zip(shifts, digits):
+            for y, digit_row in enumerate(digit_rows[d]):
+                if shift >= 0:
+                    mask, bits = digit_mask << shift, digit_row << shift
+                else:  # digit hangs off the right side
+                    mask, bits = digit_mask >> -shift, digit_row >> -shift
+                rows[y] = (rows[y] & ~mask | bits) & row_mask
+        chrdata = bitrows_to_1bpp(rows)
         # write it out
-        romdata[destaddr:destaddr + len(chrdata)] = chrdata
         if args.through is not None:
             outfile = args.outfile.replace("%d", str(number))
         else:
             outfile = args.outfile
-        with open(outfile, "wb") as outfp:
-            outfp.write(romdata)
+        if romdata is not None:
+            with open(outfile, "wb") as outfp:
+                outfp.write(romdata)
+        else:
+            try:
+                shutil.copyfile(romfilename, outfile)
+            except shutil.SameFileError:
+                pass  # patch the input in place
+        with open(outfile, "r+b") as outfp:
+            outfp.seek(destaddr)
+            outfp.write(chrdata)
         number += 1
 
 if __name__=='__main__':
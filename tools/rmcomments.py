@@ -47,35 +47,67 @@ already_public_files = set([
 #    'init.s', 'nes.inc', 'pads.s', 'ppuclear.s', 'unrom.s',
 ])
 
-precmtRE = re.compile(r"""
-^(?:            # From start of line
-[^;"'\n]+       # Match what does not begin a string or comment
-|'[^']*'        # or a single quoted string
-|"[^"]*"        # or a double quoted string
-)*
-""", re.VERBOSE)
+# A hash comment line: whitespace other than newlines, then # and the
+# rest of the line, including its newline if any
+hashcmtRE = re.compile(r"^[^\S\n]*#[^\n]*\n?", re.MULTILINE)
+
+def strip_asm_comments(text):
+    """Remove ca65 comments from the lines of text.
+
+A comment begins at a ; outside a quoted string.  Quotes do not span
+lines, so an unclosed quote is treated like a comment.  Trailing
+whitespace is removed from each line.
+
+Yield each line, ending with a newline.
+"""
+    find = text.find
+    linestart, textlen = 0, len(text)
+    while linestart < textlen:
+        lineend = find("\n", linestart)
+        if lineend < 0: lineend = textlen
+        pos = linestart
+        while True:
+            # Find the first ; or quotation mark
+            cut = lineend
+            for ch in ";'\"":
+                found = find(ch, pos, cut)
+                if found >= 0: cut = found
+            if cut == lineend or text[cut] == ';':
+                break
+            closing = find(text[cut], cut + 1, lineend)
+            if closing < 0:
+                break
+            pos = closing + 1
+        yield text[linestart:cut].rstrip() + "\n"
+        linestart = lineend + 1
 
 def strip_asm_file(srcfilename, dstfilename):
     print("strip %s to %s" % (srcfilename, dstfilename))
     with open(srcfilename, 'r') as infp:
-        lines = list(infp)
-    out = []
-    for line in lines:
-        m = precmtRE.match(line)
-        if m: line = m.group(0)
-        out.append(line.rstrip() + "\n")
+        text = infp.read()
+    # Write lines as they are found rather than joining them first
     with open(dstfilename, 'w') as outfp:
-        outfp.writelines(out)
+        outfp.writelines(strip_asm_comments(text))
+
+def strip_hash_comments(text):
+    """Blank each line of text that begins with a # comment.
+
+Each comment line becomes one newline, even the last line if it has
+no newline, so that line numbers match.
+
+>>> strip_hash_comments("a\\n  # b\\nc # d\\n")
+'a\\n\\nc # d\\n'
+>>> strip_hash_comments("a\\n# no final newline")
+'a\\n\\n'
+"""
+    return hashcmtRE.sub('\n', text)
 
 def strip_hash_file(srcfilename, dstfilename):
     print("strip %s to %s" % (srcfilename, dstfilename))
     with open(srcfilename, 'r') as infp:
-        lines = list(infp)
+        text = infp.read()
     with open(dstfilename, 'w') as outfp:
-        outfp.writelines(
-            "\n" if line.lstrip().startswith('#') else line
-            for line in lines
-        )
+        outfp.write(strip_hash_comments(text))
 
 def mkdir_p(dstdir):
     """Create a directory if it does not exist."""
@@ -88,20 +120,23 @@ def mkdir_p(dstdir):
 def main():
     for subdir in subdirs:
         mkdir_p(os.path.join(dstdir, subdir))
-        for filename in os.listdir(os.path.join(srcdir, subdir)):
-            ext = filename.rsplit('.', 1)[-1]
-            if ext.endswith('~'): continue
-            srcpath = os.path.join(srcdir, subdir, filename)
-            if not os.path.isfile(srcpath): continue
-            dstpath = os.path.join(dstdir, subdir, filename)
-            if filename in already_public_files:
-                shutil.copyfile(srcpath, dstpath)
-            elif filename.endswith(asm_suffixes):
-                strip_asm_file(srcpath, dstpath)
-            elif filename.endswith(hash_suffixes):
-                strip_hash_file(srcpath, dstpath)
-            else:
-                shutil.copyfile(srcpath, dstpath)
+        # scandir usually knows which entries are files without a stat
+        with os.scandir(os.path.join(srcdir, subdir)) as entries:
+            for entry in entries:
+                filename = entry.name
+                ext = filename.rsplit('.', 1)[-1]
+                if ext.endswith('~'): continue
+                if not entry.is_file(): continue
+                srcpath = entry.path
+                dstpath = os.path.join(dstdir, subdir, filename)
+                if filename in already_public_files:
+                    shutil.copyfile(srcpath, dstpath)
+                elif filename.endswith(asm_suffixes):
+                    strip_asm_file(srcpath, dstpath)
+                elif filename.endswith(hash_suffixes):
+                    strip_hash_file(srcpath, dstpath)
+                else:
+                    shutil.copyfile(srcpath, dstpath)
 
 if __name__=='__main__':
     main()
@@ -22,6 +22,7 @@ import sys
 import os
 import argparse
 from collections import defaultdict
+from functools import lru_cache, partial
 from PIL import Image
 
 def sliver_to_texels(lo, hi):
@@ -40,23 +41,58 @@ def chrbank_to_texels(chrdata, planes=2):
     return [_ttt(chrdata[i:i + tilelen])
             for i in range(0, len(chrdata), tilelen)]
 
+def chrbank_to_texels_np(chrdata):
+    """Decode 2bpp tiles using NumPy.
+
+Return an array of shape (number of tiles, 8, 8), padding the last
+tile with 0 as chrbank_to_texels does.  Raise ImportError if NumPy
+is not available.
+"""
+    import numpy as np
+
+    ntiles = -(-len(chrdata) // 16)
+    planes = np.zeros(ntiles * 16, np.uint8)
+    planes[:len(chrdata)] = np.frombuffer(chrdata, np.uint8)
+    # unpackbits puts the leftmost pixel (bit 7) first
+    bits = np.unpackbits(planes.reshape(ntiles, 2, 8, 1), axis=-1)
+    return bits[:, 0] | (bits[:, 1] << 1)
+
 def texels_to_pil(texels, tile_width=16, row_height=1):
     row_length = tile_width * row_height
+    # Pad the last row once so that every slice below is full width
+    emptytile = [bytes(8)] * 8
+    texels = list(texels)
+    texels.extend([emptytile] * (-len(texels) % row_length))
     tilerows = [
         texels[j:j + row_length:row_height]
         for i in range(0, len(texels), row_length)
         for j in range(i, i + row_height)
     ]
-    emptytile = [bytes(8)] * 8
-    for row in tilerows:
-        if len(row) < tile_width:
-            row.extend([emptytile] * (tile_width - len(tilerows[-1])))
     texels = [bytes(c for tile in row for c in tile[y])
               for row in tilerows for y in range(8)]
     im = Image.frombytes('P', (8 * tile_width, len(texels)), b''.join(texels))
     im.putpalette(b'\x00\x00\x00\x66\x66\x66\xb2\xb2\xb2\xff\xff\xff'*64)
     return im
 
+def texels_to_pil_np(texels, tile_width=16, row_height=1):
+    """Arrange an (ntiles, 8, 8) array of texels as texels_to_pil does.
+
+Raise ImportError if NumPy is not available.
+"""
+    import numpy as np
+
+    row_length = tile_width * row_height
+    ngroups = -(-len(texels) // row_length)
+    padded = np.zeros((ngroups * row_length, 8, 8), np.uint8)
+    padded[:len(texels)] = texels
+    # axes: group, column, tile within column, y, x
+    padded = padded.reshape(ngroups, tile_width, row_height, 8, 8)
+    pixels = np.ascontiguousarray(padded.transpose(0, 2, 3, 1, 4))
+    size = (8 * tile_width, ngroups * row_height * 8)
+    im = Image.frombuffer('P', size, pixels, 'raw', 'P', 0, 1)
+    im.putpalette(b'\x00\x00\x00\x66\x66\x66\xb2\xb2\xb2\xff\xff\xff'*64)
+    return im
+
 def render_usage(tilewidth=32):
     tiles = texels_to_pil(chrbank_to_texels(chrdata, tilewidth))
     return tiles
@@ -73,7 +109,7 @@ def parse_skip_arg(s):
     s = s.lower()
     if s == 'prg': return s
     if s.startswith("0x"): return int(s[2:], 16)
-    if s.startswith("$"): return int(s[1:], 15)
+    if s.startswith("$"): return int(s[1:], 16)
     return int(s)
 
 def parse_argv(argv):
@@ -157,7 +193,10 @@ def draw_config(config, cfgwidth, romperpixel):
     im = Image.new('L', (cfgwidth, romsize // romperpixel), 0)
     dc = ImageDraw.Draw(im)
     font = dc.getfont()
-    commaspacesize = font_getsize(font, ", ")
+    # Several memory areas may share a representative segment name,
+    # so measure each string once
+    getsize = lru_cache(maxsize=None)(partial(font_getsize, font))
+    commaspacesize = getsize(", ")
 
     # Join undersize rows with the previous
     for i in range(1, len(mem_ycoord) - 1):
@@ -172,7 +211,7 @@ def draw_config(config, cfgwidth, romperpixel):
     for y, mem in zip(mem_ycoord, config):
         if y < 0: continue
         repsegname = min(mem[2])
-        textwidth = font_getsize(font, repsegname)[0] + commaspacesize[0]
+        textwidth = getsize(repsegname)[0] + commaspacesize[0]
         need_comma = need_newline = False
         nexty = texts[-1][0] + commaspacesize[1] if texts else 0
         if not texts or y >= nexty:
@@ -213,15 +252,21 @@ def main(argv=None):
     config = None
     if configname: config = load_config(configname)
     with open(infilename, "rb") as infp:
-        header = infp.read(skip)
+        # Seek past skipped data rather than reading it into memory
         if skip_prg:
+            header = infp.read(skip)
             prgromsize = header[4] << 14
             if (header[7] & 0x0C) == 0x08:  # NES 2.0 large PRG ROM extension
                 prgromsize += (header[9] & 0x0F) << 22
-            infp.read(prgromsize)
+            skip += prgromsize
+        infp.seek(skip)
         romdata = infp.read()
-    tiles = texels_to_pil(chrbank_to_texels(romdata),
-                          twidth, args.row_height)
+    try:
+        tiles = texels_to_pil_np(chrbank_to_texels_np(romdata),
+                                 twidth, args.row_height)
+    except ImportError:
+        tiles = texels_to_pil(chrbank_to_texels(romdata),
+                              twidth, args.row_height)
 
     if configname:
         cfgwidth = 128
@@ -237,11 +282,19 @@ def main(argv=None):
         # twidth*2 ROM bytes.  In a shrunken conversion, twice that.
         cfgim = draw_config(config, cfgwidth, twidth*4)
         totalsize = (smtiles.size[0] + cfgim.size[0], smtiles.size[1])
-        tiles = Image.new("RGB", totalsize, 0)
+        tiles = Image.new("L", totalsize, 0)
         tiles.paste(smtiles, (0, 0))
         tiles.paste(cfgim, (smtiles.size[0], 0))
-        tiles = quantizetopalette(tiles, origtiles)
-        origtiles = smtiles = cfgim = None
+
+        # Rather than quantizing the whole combined image, quantize
+        # each of the 256 gray levels once and look up each pixel
+        grayramp = Image.frombytes("L", (256, 1), bytes(range(256)))
+        graytoindex = quantizetopalette(grayramp.convert("RGB"), origtiles)
+        tiles = Image.frombytes("P", totalsize,
+                                tiles.point(list(graytoindex.tobytes()))
+                                .tobytes())
+        tiles.putpalette(graytoindex.getpalette())
+        origtiles = smtiles = cfgim = grayramp = graytoindex = None
         saveargs = {'bits': 2}
     else:
         saveargs = {'bits': 2}
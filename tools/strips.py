@@ -20,6 +20,9 @@ limitations under the License.
 import re
 import textwrap
 from collections import Counter, defaultdict, namedtuple
+from contextlib import ExitStack
+from functools import lru_cache
+from itertools import chain
 import os
 import sys
 import argparse
@@ -31,6 +34,8 @@ colorRE = re.compile('#([0-9a-fA-F]+)$')
 Cel = namedtuple("Cel", "strips linenum l t w h hotx hoty hflip insubset")
 CelStrip = namedtuple("CelStrip", "palette l t w h padw padh dstx dsty")
 
+# Sheets repeat the same few colors and values, so remember them
+@lru_cache(maxsize=256)
 def parse_color(s):
     m = colorRE.match(s)
     if m:
@@ -43,6 +48,7 @@ def parse_color(s):
             return None
     return None
 
+@lru_cache(maxsize=256)
 def parseintorhex(s):
     if s.startswith('$'):
         return int(s[1:], 16)
@@ -80,21 +86,36 @@ Return a dict from node names to sets of connected nodes.
 Values in the same set will have object identity (a is b).
 
 """
-    allnames = {s: {s} for s in allnames}
+    # Union-find with path compression and union by rank
+    parent = {s: s for s in allnames}
+    rank = dict.fromkeys(parent, 0)
+
+    def find(x):
+        root = parent[x]
+        while parent[root] != root:
+            root = parent[root]
+        while parent[x] != root:
+            parent[x], x = root, parent[x]
+        return root
+
     for a, b in pairs:
         if a == b: continue
-        aset, bset = allnames[a], allnames[b]
-        if not aset.isdisjoint(bset):
+        aroot, broot = find(a), find(b)
+        if aroot == broot:
             raise ValueError(
-                "related cycle involving %s and %s"
-                % (repr(sorted(aset)), repr(sorted(bset)))
+                "related cycle involving %s"
+                % repr(sorted(s for s in parent if find(s) == aroot))
             )
-        if len(aset) < len(bset):
-            aset, bset = bset, aset
-        aset.update(bset)
-        for s in bset:
-            allnames[s] = aset
-    return allnames
+        if rank[aroot] < rank[broot]:
+            aroot, broot = broot, aroot
+        parent[broot] = aroot
+        if rank[aroot] == rank[broot]:
+            rank[aroot] += 1
+
+    groups = defaultdict(set)
+    for s in parent:
+        groups[find(s)].add(s)
+    return {s: groups[find(s)] for s in parent}
 
 class StripsFileReader(object):
 
@@ -109,6 +130,7 @@ class StripsFileReader(object):
         self.flags = {}
         self.actionpoints = {}
         self.lutaliases = {}
+        self.keywordhandlers = dict(self.appendhandlers)
         self.cur_frame_flags = {}
         self.linenum = 0
         self.verbose = verbose
@@ -127,58 +149,27 @@ class StripsFileReader(object):
         if not line or line[0].startswith('#'):
             return
 
-        # Handle predefined keywords
-        try:
-            handler = self.appendhandlers[line[0]]
-        except KeyError:
-            pass
-        else:
-            try:
-                return handler(self, line)
-            except Exception as e:
-                filename_colon = "%s: " % self.filename if self.filename else ""
-                print('%s"%s" gave %s: %s'
-                      % (filename_colon, " ".join(line), type(e).__name__, e),
-                      file=sys.stderr)
-                raise
-
-        # Handle attributes
+        # One lookup finds the handler for a predefined keyword or for
+        # an attribute, flag, or action point declared earlier
         try:
-            tablename = self.lutaliases[line[0]]
+            handler = self.keywordhandlers[line[0]]
         except KeyError:
-            pass
-        else:
-            tablevalue = parseintorhex(line[1])
-            self.lookuptables[tablename][0][-1] = tablevalue
-            self.apply_flags_to_current_frame()
+            print("warning: ignoring unknown keyword %s" % line[0],
+                  file=sys.stderr)
             return
-
-        # Handle flags, more than one of which to a line
         try:
-            self.flags[line[0]]
-        except KeyError:
-            pass
-        else:
-            for flagname in line:
-                tablename, flagvalue = self.flags[flagname]
-                self.cur_frame_flags[tablename] |= flagvalue
-                self.apply_flags_to_current_frame()
-            return
-
-        # Handle action point
-        try:
-            apvalue = self.actionpoints[line[0]]
-        except KeyError:
-            pass
-        else:
-            apvalue[0][-1] = (int(line[1]), int(line[2]))
-            return
-        
-        print("warning: ignoring unknown keyword %s" % line[0], file=sys.stderr)
+            return handler(self, line)
+        except Exception as e:
+            filename_colon = "%s: " % self.filename if self.filename else ""
+            print('%s"%s" gave %s: %s'
+                  % (filename_colon, " ".join(line), type(e).__name__, e),
+                  file=sys.stderr)
+            raise
 
     def extend(self, lines):
+        append = self.append
         for line in lines:
-            self.append(line)
+            append(line)
 
     def guess_bounding_boxes(self):
         for name, f in list(self.frames.items()):
@@ -189,15 +180,21 @@ class StripsFileReader(object):
                 raise ValueError("frame %s without strips needs explicit bounding box (try 0 0 8 8)"
                                  % name)
 
-            # Guess based on union of bounding boxes
-            if l is None:
-                l = min(row.dstx for row in strips)
-            if t is None:
-                t = min(row.dsty for row in strips)
-            if w is None:
-                w = max(row.dstx + row.w for row in strips) - l
-            if h is None:
-                h = max(row.dsty + row.h for row in strips) - t
+            # Guess based on union of bounding boxes, found in one pass
+            if l is None or t is None or w is None or h is None:
+                row = strips[0]
+                minl, mint = row.dstx, row.dsty
+                maxr, maxb = row.dstx + row.w, row.dsty + row.h
+                for row in strips:
+                    dstx, dsty = row.dstx, row.dsty
+                    if dstx < minl: minl = dstx
+                    if dsty < mint: mint = dsty
+                    if dstx + row.w > maxr: maxr = dstx + row.w
+                    if dsty + row.h > maxb: maxb = dsty + row.h
+                if l is None: l = minl
+                if t is None: t = mint
+                if w is None: w = maxr - l
+                if h is None: h = maxb - t
             f = f._replace(l=l, t=t, w=w, h=h)
             hotx, hoty = self.guess_hotspot(f)
             self.frames[name] = f._replace(hotx=hotx, hoty=hoty)
@@ -257,12 +254,12 @@ class StripsFileReader(object):
 
     def add_frame_strips(self, other_framename, offset):
         other_frame = self.frames[other_framename]
-        for strip in other_frame[0]:
-            newstrip = strip._replace(
-                l=strip.l + offset[0], t=strip.t + offset[1],
-                dstx=strip.dstx + offset[0], dsty=strip.dsty + offset[1]
-            )
-            self.cur_frame[0].append(newstrip)
+        dx, dy = offset
+        self.cur_frame[0].extend(
+            CelStrip(palette, l + dx, t + dy, w, h, padw, padh,
+                     dstx + dx, dsty + dy)
+            for palette, l, t, w, h, padw, padh, dstx, dsty in other_frame[0]
+        )
         if not any(offset):
             self.relatedframes.append((other_framename, self.cur_framename))
 
@@ -353,8 +350,7 @@ class StripsFileReader(object):
         # strip pal(,pal)*
         # strip pal(,pal)* l t w h
         # strip pal(,pal)* l t w h at dstx dsty
-        line = list(line)
-        palettes = [int(x) for x in line[1].split(",")]
+        palettes = list(map(int, line[1].split(",")))
         cliprect = self.cur_frame[2:6]
         ltwh = line[2:6] if len(line) >= 6 else cliprect
         if any(x is None for x in ltwh):
@@ -365,13 +361,13 @@ class StripsFileReader(object):
         # and put it at the destination rectangle, ignoring
         # the cel's clipping rectangle if any.
         if len(line) >= 9 and line[6] == 'at':
-            dstx, dsty = (int(x) for x in line[7:9])
+            dstx, dsty = map(int, line[7:9])
             cliprect = None, None, None, None
         else:
             dstx = dsty = None
 
         # Clip strip to cel cliprect if applicable
-        sl, st, sw, sh = ltwh = tuple(int(x) for x in ltwh)
+        sl, st, sw, sh = ltwh = tuple(map(int, ltwh))
         if sw <= 0:
             raise ValueError("%s: strip %s width is not positive"
                              % (self.framenames[-1], ltwh))
@@ -476,6 +472,7 @@ class StripsFileReader(object):
         flagvalue = line[2]
         tablename = line[4]
         self.flags[flagname] = (tablename, parseintorhex(flagvalue))
+        self.add_keyword(flagname)
 
     def append_actionpoint(self, line):
         # actionpoint fist in xtablename ytablename
@@ -493,17 +490,52 @@ class StripsFileReader(object):
             xname if xname != '-' else None,
             yname if yname != '-' else None
         )
+        self.add_keyword(apname)
 
     def append_attribute(self, line):
         # attribute attrname in tablename
         atname = line[1]
         tablename = line[3]
         self.lutaliases[atname] = tablename
+        self.add_keyword(atname)
 
     def apply_flags_to_current_frame(self):
         for tablename, flagvalue in self.cur_frame_flags.items():
             self.lookuptables[tablename][0][-1] |= flagvalue
 
+    def add_keyword(self, name):
+        """Choose the handler for a newly declared name.
+
+Predefined keywords come first, then attributes, flags, and action
+points, so that a name declared as more than one keeps its meaning.
+"""
+        if name in self.appendhandlers:
+            handler = self.appendhandlers[name]
+        elif name in self.lutaliases:
+            handler = StripsFileReader.append_attribute_value
+        elif name in self.flags:
+            handler = StripsFileReader.append_flags_used
+        else:
+            handler = StripsFileReader.append_actionpoint_value
+        self.keywordhandlers[name] = handler
+
+    def append_attribute_value(self, line):
+        tablename = self.lutaliases[line[0]]
+        tablevalue = parseintorhex(line[1])
+        self.lookuptables[tablename][0][-1] = tablevalue
+        self.apply_flags_to_current_frame()
+
+    def append_flags_used(self, line):
+        # Handle flags, more than one of which to a line
+        for flagname in line:
+            tablename, flagvalue = self.flags[flagname]
+            self.cur_frame_flags[tablename] |= flagvalue
+            self.apply_flags_to_current_frame()
+
+    def append_actionpoint_value(self, line):
+        apvalue = self.actionpoints[line[0]]
+        apvalue[0][-1] = (int(line[1]), int(line[2]))
+
     def append_align(self, line):
         num, den = len(self.frames), int(line[1])
         remainder = num % den
@@ -544,11 +576,12 @@ def makestrippaletteimg(backdrop, dstpalettes):
     """Make an image with the RGB values in the strips file's palette command."""
     sz = (max(len(x) for x in dstpalettes.values()) + 1,
           max(dstpalettes.keys()) + 1)
-    im = Image.new('RGB', sz, backdrop)
+    w, h = sz
+    pixels = bytearray(bytes(backdrop) * (w * h))
     for y, colors in dstpalettes.items():
-        for x, (rgb, mapto) in enumerate(colors):
-            im.putpixel((x, y), rgb)
-    return im
+        row = b''.join(bytes(rgb) for rgb, mapto in colors)
+        pixels[y * w * 3:y * w * 3 + len(row)] = row
+    return Image.frombytes('RGB', sz, bytes(pixels))
 
 def makecelpalettemap(backdrop, dstpalettes, celim):
     """Make a map from cel image colors to palette indices."""
@@ -559,15 +592,17 @@ def makecelpalettemap(backdrop, dstpalettes, celim):
     maxpx = max(celim.tobytes())
     p = celim.getpalette()[:3 * (maxpx + 1)]
     p.extend(backdrop * (255 - maxpx))
-    celimcopy = celim.copy()
-    celimcopy.putpalette(p)
+    # quantize() reads only the palette of the image it is given, so
+    # carry the palette on a 1x1 image rather than a copy of the cel
+    palholder = Image.new('P', (1, 1))
+    palholder.putpalette(p)
 
     # Find the closest color in the input image's palette
     # to each image in the strip's palette
     palim = makestrippaletteimg(backdrop, dstpalettes)
-    px = quantizetopalette(palim, celimcopy).load()
+    px = quantizetopalette(palim, palholder).load()
     backdropindex = px[palim.size[0] - 1, 0]
-    del celimcopy, palim
+    del palholder, palim
 
     # And arrange this as a set of mapping functions for
     # celim.point()
@@ -582,6 +617,9 @@ def makecelpalettemap(backdrop, dstpalettes, celim):
 def draw_strips_on(im, frames, actionpoints, strip_colors):
     imrgb = im.convert("RGB")
     dc = ImageDraw.Draw(imrgb)
+    # Strips are drawn in order, as later boxes overlap earlier ones,
+    # so save only the method lookups in these loops
+    rectangle, ellipse, line = dc.rectangle, dc.ellipse, dc.line
     totaltiles = 0
     scpopularity = {i: 0 for i in range(len(strip_colors))}
     for frame in frames:
@@ -593,7 +631,7 @@ def draw_strips_on(im, frames, actionpoints, strip_colors):
             totaltiles += (-(sw + padw) // 8) * (-(sh + padh) // 16)
             scpopularity[spal] += 1
             sc = strip_colors[spal]
-            dc.rectangle((sl, st, sl+sw-1, st+sh-1), outline=sc)
+            rectangle((sl, st, sl+sw-1, st+sh-1), outline=sc)
 
     # Try to find a hotspot color that contrasts with the box colors
     # in order to draw the hotspots
@@ -601,7 +639,7 @@ def draw_strips_on(im, frames, actionpoints, strip_colors):
     sc = strip_colors[spal]
     for frame in frames:
         hx, hy = frame[6:8]
-        dc.ellipse([(hx-1, hy-1), (hx+1, hy+1)], outline=sc)
+        ellipse([(hx-1, hy-1), (hx+1, hy+1)], outline=sc)
 
     for apoints in actionpoints.values():
         # each apoints value is a 3-tuple:
@@ -614,9 +652,9 @@ def draw_strips_on(im, frames, actionpoints, strip_colors):
             # Draw X on action points and a line to the hotspot
             hx, hy = f[6:8]
             apx, apy = ap
-            dc.line([(apx-1, apy-1), (apx+1, apy+1)], fill=sc)
-            dc.line([(apx+1, apy-1), (apx-1, apy+1)], fill=sc)
-            dc.line([(apx, apy), (hx, hy)], fill=sc)
+            line([(apx-1, apy-1), (apx+1, apy+1)], fill=sc)
+            line([(apx+1, apy-1), (apx-1, apy+1)], fill=sc)
+            line([(apx, apy), (hx, hy)], fill=sc)
 
     return imrgb, totaltiles
 
@@ -625,10 +663,58 @@ def make_fake_palette(backdrop):
     testpal.extend([0, 0, 0, 170, 170, 170, 255, 255, 255])
     return testpal * 64
 
+def paste_tiles_np(placements, srcims, size):
+    """Copy rectangles of pixels from images into a new image.
+
+placements -- iterable of (key into srcims, (left, top, right, bottom)
+    of source rectangle, destination x, destination y)
+srcims -- dict of indexed PIL images or 2D uint8 arrays
+size -- (width, height) of the new image
+
+Copy the indices themselves, as paste() would for mode P, without
+making a PIL image for each rectangle.  Parts of a rectangle outside
+its source image become 0, as crop() would fill them.  Raise
+ImportError if NumPy is not available.
+"""
+    import numpy as np
+
+    w, h = size
+    out = np.zeros((h, w), np.uint8)
+    srcarrays = {}
+    for key, (l, t, r, b), dstx, dsty in placements:
+        try:
+            src = srcarrays[key]
+        except KeyError:
+            src = srcims[key]
+            if not isinstance(src, np.ndarray):
+                src = np.frombuffer(
+                    src.tobytes(), np.uint8
+                ).reshape(src.size[1], src.size[0])
+            srcarrays[key] = src
+        cl, ct = max(l, 0), max(t, 0)
+        cr, cb = min(r, src.shape[1]), min(b, src.shape[0])
+        if (cl, ct, cr, cb) != (l, t, r, b):
+            out[dsty:dsty + b - t, dstx:dstx + r - l] = 0
+        if cl < cr and ct < cb:
+            dstx, dsty = dstx + cl - l, dsty + ct - t
+            out[dsty:dsty + cb - ct, dstx:dstx + cr - cl] = src[ct:cb, cl:cr]
+    return Image.frombytes('P', size, out.tobytes())
+
+def paste_tiles_pil(placements, srcims, size):
+    """Copy rectangles of pixels from images into a new image.
+
+Same as paste_tiles_np but without NumPy.
+"""
+    out = Image.new('P', size, 0)
+    for key, srcrect, dstx, dsty in placements:
+        out.paste(srcims[key].crop(srcrect), (dstx, dsty))
+    return out
+
 def collect_strip_tiles(frames, srcims):
     """
 
-srcims is the image remapped to each palette
+srcims is the image remapped to each palette, as PIL images or
+(if NumPy is available) arrays
 
 Return a 4-tuple (out, stripmap, hstripmap, totaltiles).
 out is an image containing tile data
@@ -645,10 +731,9 @@ totaltiles is the total number of tiles in out that contain data
 ##    print("frame strip lists:", [frame[0] for frame in frames])
 ##    print("expected tiles:", expectedtiles)
     totaltiles = sum(expectedtiles)
-    w = 128
-    h = -(-totaltiles // 16) * 16
-    out = Image.new('P', (w, h), 0)
-    out.putpalette(make_fake_palette((0, 204, 255)))
+    outsize = (128, -(-totaltiles // 16) * 16)
+    # Collect where each tile goes, then copy them all at once
+    placements = []
     tilessofar = 0
     stripmap = []
     hstripmap = []
@@ -662,10 +747,12 @@ totaltiles is the total number of tiles in out that contain data
         for strip in frame[0]:
             spal, sl, st, sw, sh, padw, padh, dstx, dsty = strip
             assert sw > 0 and sh > 0
-            try:
-                srcim = srcims[spal]
-            except KeyError:
+            if spal not in srcims:
                 raise ValueError("palette %d not defined" % spal)
+            # Sprite cels are centered about the bottom center
+            relx = dstx - hotx
+            tiles_in_strip = -(-(sw + padw) // 8)
+            assert tiles_in_strip > 0
             # (prx, pry) is tile location relative to the strip+padding
             for pry in range(0, sh + padh, 16):
                 # The top of the output strip is srcboxtop
@@ -684,32 +771,38 @@ totaltiles is the total number of tiles in out that contain data
 
                     tdstx = (tilessofar % 16) * 8 + (srcleft - srcboxleft)
                     tdsty = (tilessofar // 16) * 16 + (srctop - srcboxtop)
-                    out.paste(srcim.crop(srcrect), (tdstx, tdsty))
+                    placements.append((spal, srcrect, tdstx, tdsty))
                     tilessofar += 1
 
-                # Sprite cels are centered about the bottom center
-                tiles_in_strip = -(-(sw + padw) // 8)
-                assert tiles_in_strip > 0
+                # Each 16-pixel row of a strip is its own horizontal
+                # strip of sprites, with its own y
                 framestrips.append((
-                    dstx - hotx, dstboxtop - hoty, spal, tiles_in_strip
+                    relx, dstboxtop - hoty, spal, tiles_in_strip
                 ))
         hstripmap.append(framestrips)
 ##        print("frame tiles:", tilessofar - stripmap[-1], file=sys.stderr)
 
     assert totaltiles == tilessofar
+    try:
+        out = paste_tiles_np(placements, srcims, outsize)
+    except ImportError:
+        out = paste_tiles_pil(placements, srcims, outsize)
+    out.putpalette(make_fake_palette((0, 204, 255)))
     return out, stripmap, hstripmap, totaltiles
 
-def ibatch(iterable, length):
-    """Collect an iterable into lists of a given length."""
+def remap_cel_np(celim, palmaps):
+    """Remap an indexed image through each of several maps.
 
-    out = []
-    for el in iterable:
-        out.append(el)
-        if len(out) >= length:
-            yield out
-            out = []
-    if out:
-        yield out
+Read the image's pixels once and return {key: 2D uint8 array} for
+use by paste_tiles_np, instead of making a PIL image per map with
+point().  Raise ImportError if NumPy is not available.
+"""
+    import numpy as np
+
+    w, h = celim.size
+    cel = np.frombuffer(celim.tobytes(), np.uint8).reshape(h, w)
+    return {plane: np.array(palmap, np.uint8)[cel]
+            for plane, palmap in palmaps.items()}
 
 def strips_to_tiles(frames, celim, backdrop, dstpalettes, outname=None):
     """Extract strips from an image as tiledata.
@@ -729,23 +822,47 @@ tiledata -- is a list of 8x16 pixel NES tiles
 
     # Actually map the palettes
     palmaps = makecelpalettemap(backdrop, dstpalettes, celim)
-    palims = {plane: celim.point(palmap)
-              for plane, palmap in palmaps.items()}
+    try:
+        palims = remap_cel_np(celim, palmaps)
+    except ImportError:
+        palims = {plane: celim.point(palmap)
+                  for plane, palmap in palmaps.items()}
     stripdata = collect_strip_tiles(frames, palims)
     tileim, stripmap, hstripmap, totaltiles = stripdata
     if outname:
         tileim.save(outname)
     tiledata = pilbmp2chr(tileim, tileHeight=16)
-    tiledata = [b''.join(s) for s in ibatch(tiledata[:2 * totaltiles], 2)]
+    # Join each top half (8x8 tile) to its bottom half
+    halves = iter(tiledata[:2 * totaltiles])
+    tiledata = [b''.join(s) for s in zip(halves, halves)]
 
     return tiledata, stripmap, hstripmap
 
+def strips_file_to_tiles(frames, celimfilename, backdrop, dstpalettes,
+                         outname=None):
+    """Open a cel image and extract strips from it as tiledata.
+
+This takes a filename rather than an image so that it can run in
+a worker process.  Returns the same as strips_to_tiles().
+"""
+    with Image.open(celimfilename) as celim:
+        return strips_to_tiles(frames, celim, backdrop, dstpalettes, outname)
+
 def vflip(tile):
     """Vertically flips a byte string representing a column of NES tiles."""
-    out1 = b''.join(bytes(tile[t + 7:t - 1 if t > 0 else None:-1])
-                    + bytes(tile[t + 15:t + 7:-1])
-                    for t in range(len(tile) - 16, -16, -16))
-    return out1
+    if len(tile) % 16:
+        return b''.join(bytes(tile[t + 7:t - 1 if t > 0 else None:-1])
+                        + bytes(tile[t + 15:t + 7:-1])
+                        for t in range(len(tile) - 16, -16, -16))
+    # Reversing the column reverses the order of tiles and of rows but
+    # also puts each tile's plane 1 before plane 0.  Swap them back
+    # by treating each 8-byte plane as one item.
+    planes = memoryview(bytearray(tile[::-1])).cast('Q')
+    out = bytearray(len(tile))
+    outplanes = memoryview(out).cast('Q')
+    outplanes[0::2] = planes[1::2]
+    outplanes[1::2] = planes[0::2]
+    return bytes(out)
 
 hflipsliver = bytearray([0])
 for shamt in range(8):
@@ -753,7 +870,7 @@ for shamt in range(8):
     hflipsliver.extend(c | px for c in hflipsliver)
 def hflip(tile):
     """Horizontally flips a byte string representing planar tiles."""
-    return bytes(hflipsliver[sliver] for sliver in tile)
+    return bytes(tile).translate(hflipsliver)
 
 def dedupe_seq(data):
     """Find unique items and a map for expansion.
@@ -765,13 +882,9 @@ that data[i] == uniqueitems[uses[i]].
     uniqueindices = {}
     uses = []
     for item in data:
-        uniqueindices.setdefault(item, len(uniqueindices))
-        uses.append(uniqueindices[item])
-    uniqueitems = [None] * len(uniqueindices)
-    while uniqueindices:
-        item, i = uniqueindices.popitem()
-        uniqueitems[i] = item
-    return uniqueitems, uses
+        uses.append(uniqueindices.setdefault(item, len(uniqueindices)))
+    # Dicts keep insertion order, which is index order
+    return list(uniqueindices), uses
 
 def dedupe_tiles_with_flip(data):
     """Find unique NES tiles up to flipping and a map for expansion.
@@ -781,41 +894,39 @@ items from data and order is a list of (index, flipvalue) tuples in
 uniqueitems, such that data[i] == uniqueitems[uses[i][0]] flipped by
 uses[i][1] where bit 7 means vertical flipping and bit 6 horizontal.
 """
-    uniqueindices = {}
-    uses = []
+    # Map all four flips of each unique item to its use, so that a
+    # repeated item costs one lookup and only new items are flipped.
+    # setdefault keeps the least flipped use of a symmetric item.
+    uses_by_flip = {}
+    uniqueitems, uses = [], []
     for item in data:
-        if item in uniqueindices:
-            uses.append((uniqueindices[item], 0x00))
-            continue
-        fitem = hflip(item)
-        if fitem in uniqueindices:
-            uses.append((uniqueindices[fitem], 0x40))
-            continue
-        fitem = vflip(item)
-        if fitem in uniqueindices:
-            uses.append((uniqueindices[fitem], 0x80))
-            continue
-        fitem = hflip(fitem)
-        if fitem in uniqueindices:
-            uses.append((uniqueindices[fitem], 0xC0))
-            continue
-        uses.append((len(uniqueindices), 0x00))
-        uniqueindices[item] = len(uniqueindices)
-
-    uniqueitems = [None] * len(uniqueindices)
-    while uniqueindices:
-        item, i = uniqueindices.popitem()
-        uniqueitems[i] = item
+        use = uses_by_flip.get(item)
+        if use is None:
+            use = (len(uniqueitems), 0x00)
+            uniqueitems.append(item)
+            vitem = vflip(item)
+            uses_by_flip.setdefault(item, use)
+            uses_by_flip.setdefault(hflip(item), (use[0], 0x40))
+            uses_by_flip.setdefault(vitem, (use[0], 0x80))
+            uses_by_flip.setdefault(hflip(vitem), (use[0], 0xC0))
+        uses.append(use)
     return uniqueitems, uses
 
 
+# Each bit of a byte spread out to the low bit of its own byte,
+# leftmost pixel (bit 7) in the most significant byte
+_sliver_spread = [
+    int.from_bytes(bytes((c >> i) & 1 for i in range(7, -1, -1)), "big")
+    for c in range(256)
+]
+
 def sliver_to_texels(lo, hi):
-    return bytes(((lo >> i) & 1) | (((hi >> i) & 1) << 1)
-                 for i in range(7, -1, -1))
+    return (_sliver_spread[lo] | _sliver_spread[hi] << 1).to_bytes(8, "big")
 
 def tile_to_texels(chrdata):
-    _stt = sliver_to_texels
-    return [_stt(a, b)
+    # sliver_to_texels inlined, as this runs once per row of pixels
+    spread = _sliver_spread
+    return [(spread[a] | spread[b] << 1).to_bytes(8, "big")
             for i in range(0, len(chrdata), 16)
             for (a, b) in zip(chrdata[i:i+8], chrdata[i+8:i+16])]
 
@@ -835,6 +946,29 @@ def texels_to_pil(texels, tile_width=16):
     out.putpalette(make_fake_palette((0, 204, 255)))
     return out
 
+def texels_to_pil_np(texels, tile_width=16):
+    """Arrange tiles of texels as texels_to_pil does, using NumPy.
+
+All tiles must have the same number of rows.  Raise ImportError if
+NumPy is not available.
+"""
+    import numpy as np
+
+    ntiles, tile_height = len(texels), len(texels[0])
+    ngroups = -(-ntiles // tile_width)
+    ncols = min(ntiles, tile_width)
+    padded = np.zeros((ngroups * ncols, tile_height, 8), np.uint8)
+    padded[:ntiles] = np.frombuffer(
+        b''.join(row for tile in texels for row in tile), np.uint8
+    ).reshape(ntiles, tile_height, 8)
+    # axes: group, tile within group, y, x -> group, y, tile, x
+    pixels = padded.reshape(ngroups, ncols, tile_height, 8)
+    pixels = pixels.transpose(0, 2, 1, 3)
+    size = (ncols * 8, ngroups * tile_height)
+    out = Image.frombytes('P', size, pixels.tobytes())
+    out.putpalette(make_fake_palette((0, 204, 255)))
+    return out
+
 def setsimilarities(sets, othersets=None):
     """Find the most similar elements in an iterable of iterables.
 
@@ -844,20 +978,36 @@ sets -- column 1
 othersets -- column 2; if None use sets
 
 Return a list of (sets index, othersets index, number of shared elements)
+for pairs with sets index < othersets index that share at least one
+element, most shared first.
 """
-    sets = [frozenset(s) for s in sets]
-    othersets = ([frozenset(s) for s in othersets]
-                 if othersets is not None
-                 else sets)
+    othersets = othersets if othersets is not None else sets
+    # Count shared elements through an index from each element to the
+    # othersets containing it, so that pairs sharing nothing cost nothing
+    containing = defaultdict(list)
+    for bi, b in enumerate(othersets):
+        for item in frozenset(b):
+            containing[item].append(bi)
+    shared = Counter()
+    for ai, a in enumerate(sets):
+        for item in frozenset(a):
+            shared.update((ai, bi) for bi in containing.get(item, ())
+                          if bi > ai)
     return sorted((
-        (ai, bi, len(a.intersection(b)))
-        for ai, a in enumerate(sets)
-        for bi, b in enumerate(othersets)
-        if bi > ai
+        (ai, bi, n) for (ai, bi), n in sorted(shared.items())
     ), key=(lambda row: row[2]), reverse=True)
 
-def form_framedef(idxs, hsm, hflip):
-    asmlines = []
+# Hexadecimal strings of all byte values, quicker to look up than
+# to format one at a time
+_HEX_BYTE_STRS = {i: "$%02X" % i for i in range(256)}
+
+def framedef_rows(idxs, hsm, hflip):
+    """Find the bytes of each horizontal strip of a metasprite.
+
+Return a tuple of (x, y, attributes, tile number, ...) tuples, which
+frames can be compared by before they are formatted.
+"""
+    rows = []
     idxi = iter(idxs)
     for xbase, y, palette, length in hsm:
         assert length>0
@@ -867,26 +1017,36 @@ def form_framedef(idxs, hsm, hflip):
             tilenums = [t ^ 0x40 for t in reversed(tilenums)]
         hexs = [xbase + 0x80, y + 0x80, palette + (length - 1) * 4]
         hexs.extend(tilenums)
-        asmlines.append("  .byte " + ','.join("$%02X" % x for x in hexs))
+        rows.append(tuple(hexs))
+    return tuple(rows)
+
+def framedef_rows_to_asm(rows):
+    asmlines = []
+    for hexs in rows:
+        try:
+            hexs = ','.join(map(_HEX_BYTE_STRS.__getitem__, hexs))
+        except KeyError:
+            # Let ca65 complain about a sprite too far off the hotspot
+            hexs = ','.join("$%02X" % x for x in hexs)
+        asmlines.append("  .byte " + hexs)
     asmlines.append("  .byte 0")
     return '\n'.join(asmlines)
 
 def ca65_bytearray(s):
-    s = ['  .byte ' + ','.join(str(ch) for ch in s[i:i + 16])
-         for i in range(0, len(s), 16)]
-    return '\n'.join(s)
+    s = list(map(str, s))
+    return '\n'.join('  .byte ' + ','.join(s[i:i + 16])
+                     for i in range(0, len(s), 16))
 
 def ca65_addrarray(s):
-    s = ['  .addr ' + ','.join(str(ch) for ch in s[i:i + 4])
-         for i in range(0, len(s), 4)]
-    return '\n'.join(s)
+    s = list(map(str, s))
+    return '\n'.join('  .addr ' + ','.join(s[i:i + 4])
+                     for i in range(0, len(s), 4))
 
-def form_table(tablename, tablevalues, segment):
+def form_table(tablename, tablevalues):
     strtablevalues = [
         ('<%d' % v if -128 <= v < 0 else '%d' % v) for v in tablevalues
     ]
     lines = [
-        '.segment "%s"' % segment,
         '.export %s' % tablename,
         '%s:' % tablename,
         ca65_bytearray(strtablevalues)
@@ -945,8 +1105,11 @@ framenumaliases -- [(alternate name, frame number), ...] from aka
     celim = Image.open(celimfilename)
 
     # Load list of frames on this sprite sheet
+    # Read the file in one call and split it, rather than asking the
+    # file object for one line at a time
     with open(stripsfilename, "r", encoding="utf-8") as infp:
-        stripsfile = StripsFileReader(infp)
+        stripslines = infp.read().split("\n")
+    stripsfile = StripsFileReader(stripslines)
     frames = stripsfile.frames
     framenames = stripsfile.framenames
     backdrop = stripsfile.backdrop
@@ -961,32 +1124,41 @@ framenumaliases -- [(alternate name, frame number), ...] from aka
         imrgb, totaltiles = draw_strips_on(celim, framesinorder, stripsfile.actionpoints, strip_colors)
         imrgb.save(celimbasename + "-boxing.png")
 
-    # Extract tiles from cel sheets
+    # Extract tiles from cel sheets.  The flipped sheet is independent
+    # of the normal one, so extract it in another process meanwhile.
     alltiles_name = (celimbasename + "-tiles.png" if verbose else None)
-    sttnormal = strips_to_tiles(framesinorder, celim, backdrop, dstpalettes,
-                                alltiles_name)
-    tiledata, stripmap, hstripmap = sttnormal
-    celim.close()
-    assert len(stripmap) == len(framesinorder)
-
-    if celimfilename_flip:
-        celimbasename_flip = os.path.splitext(os.path.basename(celimfilename_flip))[0]
-        celimq = Image.open(celimfilename_flip) if celimfilename_flip else celim
-        alltiles_name_flip = (celimbasename_flip + "-tiles.png"
-                              if verbose
-                              else None)
-        sttflip = strips_to_tiles(framesinorder, celimq, backdrop, dstpalettes,
-                                  alltiles_name_flip)
-        celimq.close()
-        tiledataq = sttflip[0]
-        assert len(tiledataq) == len(tiledata)
-    else:
-        tiledataq = tiledata
+    with ExitStack() as stack:
+        if celimfilename_flip:
+            celimbasename_flip = os.path.splitext(
+                os.path.basename(celimfilename_flip)
+            )[0]
+            alltiles_name_flip = (celimbasename_flip + "-tiles.png"
+                                  if verbose
+                                  else None)
+            # Importing the process pool takes longer than parsing
+            # arguments, so import it only when it is used
+            from concurrent.futures import ProcessPoolExecutor
+            executor = stack.enter_context(ProcessPoolExecutor(max_workers=1))
+            sttflip = executor.submit(
+                strips_file_to_tiles, framesinorder, celimfilename_flip,
+                backdrop, dstpalettes, alltiles_name_flip
+            )
+        sttnormal = strips_to_tiles(framesinorder, celim, backdrop,
+                                    dstpalettes, alltiles_name)
+        tiledata, stripmap, hstripmap = sttnormal
+        celim.close()
+        assert len(stripmap) == len(framesinorder)
+
+        if celimfilename_flip:
+            tiledataq = sttflip.result()[0]
+            assert len(tiledataq) == len(tiledata)
+        else:
+            tiledataq = tiledata
 
     # Each tile normally appears twice in alltiles: once for the
     # unflipped version and once for the flipped version.  In HH86,
     # these correspond to 'p' and 'q' on Donny's shirt and cap.
-    alltiles = [tile for lr in zip(tiledata, tiledataq) for tile in lr]
+    alltiles = list(chain.from_iterable(zip(tiledata, tiledataq)))
 
     if stripsfile.lookuptables:
         stripsfile.calc_actionpoints()
@@ -1015,12 +1187,14 @@ def main(argv=None):
         blanktileindex = None
     frameuses = [uses[stripmap[f] * 2:stripmap[f + 1] * 2]
                  for f in range(len(framesinorder))]
-    frameswithflip = set(i for i, u in enumerate(frameuses)
-                         if any(x[1] for x in u))
+    # Unique tiles used by each frame, ignoring flips
+    frametilesets = [frozenset(x[0] for x in u) for u in frameuses]
     if write_intermediate:
+        frameswithflip = [i for i, u in enumerate(frameuses)
+                          if any(x[1] for x in u)]
         print("%d frames, %d 8x16 tiles per side, %d unique tiles"
               % (len(framesinorder), len(alltiles) // 2, len(uniquetiles)))
-        simis = [row for row in setsimilarities(frameuses) if row[2] > 0]
+        simis = setsimilarities(frameuses)
         if simis:
             print("Frames sharing most tiles:")
             print("\n".join("%s and %s: %s"
@@ -1032,15 +1206,15 @@ def main(argv=None):
             print("No two frames share a tile")
         if frameswithflip:
             print("%d containing flipped tiles:" % len(frameswithflip))
-            simis = [framenames[i] for i in sorted(frameswithflip)]
+            simis = [framenames[i] for i in frameswithflip]
             print(textwrap.fill(", ".join(simis)))
         else:
             print("No frames use flipped tiles")
 
         if blanktileindex is not None:
             print("Blank tile is unique tile %d" % blanktileindex)
-            frameswithblank = [i for i, u in enumerate(frameuses)
-                               if any(x[0] == blanktileindex for x in u)]
+            frameswithblank = [i for i, ts in enumerate(frametilesets)
+                               if blanktileindex in ts]
             assert frameswithblank
             if frameswithblank:
                 print("Frames with a blank tile (which increases flicker):")
@@ -1069,7 +1243,7 @@ def main(argv=None):
             rel = {f}
         seen_related.update((f2, f) for f2 in rel)
         # Find all individual tiles across these cels
-        tilesneeded = {x[0] for relf in rel for x in frameuses[relf]}
+        tilesneeded = set().union(*(frametilesets[relf] for relf in rel))
         if tilesneeded: job["tiles"].append(sorted(tilesneeded))
 
     # Place tiles in banks
@@ -1103,15 +1277,28 @@ def main(argv=None):
                 print("%s: allocating new bank %d; suboptimal packing?"
                       % (stripsfilename, len(tilesinbank)), file=sys.stderr)
                 tilesinbank.append(set(tilesneeded))
+        tilesinbank = [sorted(ts) for ts in tilesinbank]
+
+    # From here on, each bank's tiles are a sorted list, and
+    # banktilesets holds the same banks as sets for subset tests
 
     num_tiles = len(tilesinbank[-1]) + sizeof_bank * (len(tilesinbank) - 1)
 
-    # Find which frames use each tile
+    # Find which frames use each tile.  Only banks containing one
+    # of a frame's tiles can contain all of them, so test only those,
+    # still putting each frame in the first such bank.
     framesinbank = [set() for i in tilesinbank]
-    for f, ftiles in enumerate(frameuses):
-        ftiles = set(row[0] for row in ftiles)
-        for b, btiles in enumerate(tilesinbank):
-            if not ftiles.difference(btiles):
+    banktilesets = [frozenset(ts) for ts in tilesinbank]
+    banks_with_tile = defaultdict(list)
+    for b, btiles in enumerate(banktilesets):
+        for t in btiles:
+            banks_with_tile[t].append(b)
+    allbanks = range(len(banktilesets))
+    for f, ftiles in enumerate(frametilesets):
+        candidates = (banks_with_tile.get(next(iter(ftiles)), ())
+                      if ftiles else allbanks)
+        for b in candidates:
+            if ftiles <= banktilesets[b]:
                 framesinbank[b].add(f)
                 break
         else:
@@ -1121,15 +1308,16 @@ def main(argv=None):
 
     if write_intermediate:
         print("Tile count: %d; in each bank:" % num_tiles)
-        print("\n".join(textwrap.fill("%d: %s" % (b, ', '.join(str(tn) for tn in sorted(ts))))
+        print("\n".join(textwrap.fill("%d: %s" % (b, ', '.join(str(tn) for tn in ts)))
                         for b, ts in enumerate(tilesinbank)))
+        framesinbank_sorted = [sorted(ts) for ts in framesinbank]
         print("Frames in each bank:")
-        print("\n".join(textwrap.fill("%d: %s" % (b, ', '.join(framenames[f] for f in sorted(ts))))
-                        for b, ts in enumerate(framesinbank)))
+        print("\n".join(textwrap.fill("%d: %s" % (b, ', '.join(framenames[f] for f in ts)))
+                        for b, ts in enumerate(framesinbank_sorted)))
         print("Subset frames in each bank:")
-        print("\n".join(textwrap.fill("%d: %s" % (b, ', '.join(framenames[f] for f in sorted(ts) if framesinorder[f][9])))
-                        for b, ts in enumerate(framesinbank)))
-        simis = [row for row in setsimilarities(tilesinbank) if row[2] > 0]
+        print("\n".join(textwrap.fill("%d: %s" % (b, ', '.join(framenames[f] for f in ts if framesinorder[f][9])))
+                        for b, ts in enumerate(framesinbank_sorted)))
+        simis = setsimilarities(tilesinbank)
         if simis:
             print("Banks sharing most tiles:")
             print("\n".join("%d and %d: %s" % (a, b, n)
@@ -1140,7 +1328,6 @@ def main(argv=None):
         simis.clear()
 
     # Write tiles
-    tilesinbank = [sorted(ts) for ts in tilesinbank]  # Convert sets to lists
     banktilesheets = [[uniquetiles[x] for x in ts] for ts in tilesinbank]
     if write_intermediate:
         print("Bank tile sheets length is", [len(x) for x in banktilesheets])
@@ -1149,19 +1336,23 @@ def main(argv=None):
         ts.extend([solidtile] * (sizeof_bank - len(ts)))
     if chrfilename:
         with open(chrfilename, 'wb') as outfp:
+            # One write per bank rather than one per tile
             for ts in banktilesheets:
-                outfp.writelines(ts)
+                outfp.write(b''.join(ts))
     if write_intermediate:
         print("Bank tile sheets padded to", [len(x) for x in banktilesheets])
         texels1 = [tile_to_texels(x) for ts in banktilesheets for x in ts]
-        im = texels_to_pil(texels1, sizeof_bank)
+        try:
+            im = texels_to_pil_np(texels1, sizeof_bank)
+        except ImportError:
+            im = texels_to_pil(texels1, sizeof_bank)
         celimbasename = os.path.splitext(os.path.basename(celimfilename))[0]
         im.save(celimbasename + "-uniquetiles.png")
 
     # Find which bank to use for each frame
-    frametobank = {}
-    for banknum, ts in enumerate(framesinbank):
-        frametobank.update((framenum, banknum) for framenum in ts)
+    frametobank = {framenum: banknum
+                   for banknum, ts in enumerate(framesinbank)
+                   for framenum in ts}
 
     if max(frametobank) + 1 > len(frametobank):
         missingframes = [i for i in range(max(frametobank) + 1)
@@ -1178,9 +1369,11 @@ def main(argv=None):
     # Find the counterpart within the bank to each tile
     # TODO: Don't allow flipping between normal and L versions of same tile
     tilesinframebybank = []
+    # Position of each unique tile in its bank's sorted list
+    tileposinbank = [{tn: i for i, tn in enumerate(t)} for t in tilesinbank]
     for f, (u, bank) in enumerate(zip(frameuses, frametobank)):
-        t = tilesinbank[bank]
-        unormalflip = [[(t.index(tn[0]), tn[1]) for tn in tns]
+        tpos = tileposinbank[bank]
+        unormalflip = [[(tpos[tn[0]], tn[1]) for tn in tns]
                        for tns in zip(u[0::2], u[1::2])]
         found_bad_lr = 0
         for l, r in unormalflip:
@@ -1200,8 +1393,9 @@ def main(argv=None):
     framedefsinv = {}
     for i, (idxs, hsm, frame) \
         in enumerate(zip(tilesinframebybank, hstripmap, framesinorder)):
+        # Compare frames by their bytes and format only unique ones
         hflipped = frame[8]
-        fd = form_framedef(idxs, hsm, hflipped)
+        fd = framedef_rows(idxs, hsm, hflipped)
         if fd not in framedefsinv:
             framedefsinv[fd] = []
             framedefs.append(fd)
@@ -1245,24 +1439,29 @@ def main(argv=None):
     for fd in framedefs:
         asmlines.extend('mspr_%s:' % framenames[i]
                         for i in framedefsinv[fd])
-        asmlines.append(fd)
+        asmlines.append(framedef_rows_to_asm(fd))
 
     # Add lookup tables
     if luts:
+        # Start each segment once, with its tables in the order in
+        # which they were declared
         asmlines.append("; lookup tables "+'-'*30)
-        asmlines.extend(
-            form_table(tn, values, seg)
-            for tn, (values, _, seg, _) in luts.items()
-        )
+        bysegment = defaultdict(list)
+        for tn, (values, _, seg, _) in luts.items():
+            bysegment[seg].append(form_table(tn, values))
+        for seg, tables in bysegment.items():
+            asmlines.append('.segment "%s"' % seg)
+            asmlines.extend(tables)
 
     if asmfilename:
-        asmlines.append('')
-        asmlines = '\n'.join(asmlines)
+        # Write each line as it is terminated rather than joining the
+        # whole file into one string first
+        asmlines = (line + '\n' for line in asmlines)
         if asmfilename == '-':
-            sys.stdout.write(asmlines)
+            sys.stdout.writelines(asmlines)
         else:
             with open(asmfilename, 'w', encoding="utf-8") as outfp:
-                outfp.write(asmlines)
+                outfp.writelines(asmlines)
 
     # Write frame number, bank, and first tile number for each frame
     if framenumfilename:
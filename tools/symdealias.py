@@ -23,6 +23,7 @@ freely, subject to the following restrictions:
 """
 import sys, os, argparse
 from collections import defaultdict, namedtuple
+from ld65dbg import nvp_get
 
 helpText="Strips alias symbols from an ld65 debug symbol file."
 helpEnd= ""
@@ -34,41 +35,38 @@ def parse_argv(argv):
                    help="path of debug symbol file to write")
     return p.parse_args(argv[1:])
 
-def parse_nvp_line(line):
-    line = line.rstrip().split("\t", 1)
-    symtype = line[0]
-    props = (dict(tuple(item.split("=", 1)) for item in line[1].split(","))
-             if len(line) > 1
-             else {})
-    return symtype, props
-
 SymEntry = namedtuple('SymEntry', [
     'name', 'score', 'orig_line'
 ])
 
 def main(argv=None):
     args = parse_argv(argv or sys.argv)
-    with open(args.dbgfile, "r") as infp:
+    with open(args.dbgfile, "rb") as infp:
         lines = list(infp)
     out = []
     symlines = []
     rom_seg_base = {}  # {id: ooffs-start, ...}
     importcount = defaultdict(int)
+
+    # Only seg and sym lines are parsed, and only for the keys used.
+    # All other lines are copied through as bytes.
+    get = nvp_get
     for line in lines:
-        symtype, props = parse_nvp_line(line)
-        if symtype == 'seg' and 'ooffs' in props:
-            segid = int(props["id"])
-            seg_base = int(props["ooffs"], 0) - int(props["start"], 0)
-            rom_seg_base[segid] = seg_base
-        if symtype != 'sym':
+        symtype, _, tail = line.partition(b"\t")
+        if symtype == b'seg':
+            ooffs = get(tail, b'ooffs=')
+            if ooffs is not None:
+                seg_base = int(ooffs, 0) - int(get(tail, b'start='), 0)
+                rom_seg_base[int(get(tail, b'id='))] = seg_base
+        if symtype != b'sym':
             out.append(line)
             continue
-        if 'scope' not in props:  # @labels and unnamed labels
+        if get(tail, b'scope=') is None:  # @labels and unnamed labels
             continue
-        if props["type"] == 'imp':
-            importcount[props['name']] += 1
+        if get(tail, b'type=') == b'imp':
+            importcount[get(tail, b'name=')] += 1
             continue
-        symlines.append((props, line))
+        symlines.append((tail, line))
     print("%d sym lines, %d other lines, %d ROM segments"
           % (len(symlines), len(out), len(rom_seg_base)),
           file=sys.stderr)
@@ -77,22 +75,22 @@ def main(argv=None):
     # entry is (name, score, line)
     # segs is 
     valtosyms = defaultdict(list)
-    for props, line in symlines:
+    for tail, line in symlines:
         # Drop values outside address space or in the local variable
         # area of zero page
-        val = int(props['val'], 0)
+        val = int(get(tail, b'val='), 0)
         if not 0x0010 <= val <= 0x10000: continue
         # Drop ROM values without a segment
-        seg = props.get("seg")
+        seg = get(tail, b'seg=')
         if val >= 0x8000 and seg is None: continue
         seg = int(seg) if seg is not None else None
         seg_base = rom_seg_base.get(seg) if seg is not None else None
         # Because $6000-$7FFF is not bankable on this cartridge,
         # (seg_base, val) uniquely identifies a ROM address
 
-        name = props["name"]
-        is_lab = props['type'] == 'lab'
-        has_size = int(props.get('size', '0')) > 0
+        name = get(tail, b'name=')
+        is_lab = get(tail, b'type=') == b'lab'
+        has_size = int(get(tail, b'size=', b'0')) > 0
         score = (1 + (2 if is_lab else 0)
                  + (1 if seg is not None else 0) + (1 if has_size else 0))
         score = score * (1 + importcount[name])
@@ -104,9 +102,10 @@ def main(argv=None):
         out.append(chosen.orig_line)
 
     if args.output == '-':
-        sys.stdout.writelines(out)
+        sys.stdout.flush()
+        sys.stdout.buffer.writelines(out)
     else:
-        with open(args.output, "w") as outfp:
+        with open(args.output, "wb") as outfp:
             outfp.writelines(out)
 
 if __name__=='__main__':
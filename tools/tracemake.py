@@ -17,7 +17,7 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
-import os, sys, subprocess, shlex, re, time
+import os, sys, subprocess, shlex, re, time, mmap
 
 TOOLSDIR = os.path.dirname(os.path.abspath(sys.argv[0]))
 BASEDIR = os.path.normpath(os.path.join(TOOLSDIR, ".."))
@@ -64,6 +64,17 @@ argsRE = re.compile(r"""
 ([a-zA-Z0-9_|]+|".*?"|{.*?}|\[.*?\])
 """, re.VERBOSE)
 
+# Nearly all lines are openat calls in the current directory, so look
+# for them first in the undecoded log and skip splitting their arguments
+openatRE = re.compile(rb"""
+(?:\[pid\s+[0-9]+\]\s*)?  # PID (ignored)
+openat\(AT_FDCWD,\s*
+"([^"]*)",\s*            # filename
+([A-Z_|]+)                # flags
+(?:,\s*[0-7]+)?           # mode of a created file
+\)\s*=\s*
+""", re.VERBOSE)
+
 def analyze_log():
     if False:
         msg = """execve("/usr/bin/python3", ["python3", "tools/mtcv.py", "maps/DF/DF_B5_7B.maps", "obj/nes/DF_B5_7B.fqmap"], 0x5636cfc0ae50 /* 55 vars */) = 0
@@ -77,67 +88,77 @@ def analyze_log():
         m = exitedRE.match(msg)
         print(m.groups())
         return
-    with open(LOGNAME, "r", encoding="utf-8") as infp:
-        stderr = [x.rstrip() for x in infp]
     readfiles, readfolders, writtenfiles = set(), set(), set()
-    for line in stderr:
-
-        if line.startswith("strace: Process"): continue
-        if exitedRE.match(line): continue
-        m = loglineRE.match(line)
-        if not m:
-            if print_malformed_loglines:
-                print("MALFORMED LINE", line)
-            continue
-
-        callname, args = m.groups()
-        allargs = argsRE.split(args)
-        if (len(allargs) % 2 != 1
-                or allargs[0].strip() or allargs[-1].strip()
-                or not all(x.strip() == ',' for x in allargs[2:-2:2])):
-            print("MALFORMED START/FINISH", args)
-            continue
-        allargs = allargs[1:-1:2]
-        
-        if callname == 'openat':
-            if (allargs[0] != 'AT_FDCWD'):
-                print("strange openat", line)
-                continue
-            filename = allargs[1].strip('"')
-            if filename.startswith(ignore_folders): continue
-            if '/__pycache__/' in filename: continue
-            if filename.startswith(".."):
-                print("traversal to %s" % filename, file=sys.stderr)
-            filename = os.path.normpath(os.path.join(BASEDIR, filename))
-            modes = allargs[2].split("|")
-            if 'O_DIRECTORY' in modes and 'O_RDONLY' in modes:
-                readfolders.add(filename)
-                continue
-            if 'O_RDWR' in modes:
-                if filename not in writtenfiles:
+    # Map the log rather than reading it, and decode only the parts
+    # of each line that are used.  mmap cannot map an empty file,
+    # so read an empty log through the file itself.
+    with open(LOGNAME, "rb") as infp, \
+         (mmap.mmap(infp.fileno(), 0, access=mmap.ACCESS_READ)
+          if os.fstat(infp.fileno()).st_size
+          else infp) as mm:
+        for line in iter(mm.readline, b''):
+            m = openatRE.match(line)
+            if m:
+                callname = 'openat'
+                filename, modes = m.group(1).decode(), m.group(2).decode()
+            else:
+                line = line.decode().rstrip()
+                if line.startswith("strace: Process"): continue
+                if exitedRE.match(line): continue
+                m = loglineRE.match(line)
+                if not m:
+                    if print_malformed_loglines:
+                        print("MALFORMED LINE", line)
+                    continue
+
+                callname, args = m.groups()
+                allargs = argsRE.split(args)
+                if (len(allargs) % 2 != 1
+                        or allargs[0].strip() or allargs[-1].strip()
+                        or not all(x.strip() == ',' for x in allargs[2:-2:2])):
+                    print("MALFORMED START/FINISH", args)
+                    continue
+                allargs = allargs[1:-1:2]
+                if callname == 'openat':
+                    if (allargs[0] != 'AT_FDCWD'):
+                        print("strange openat", line)
+                        continue
+                    filename, modes = allargs[1].strip('"'), allargs[2]
+
+            if callname == 'openat':
+                if filename.startswith(ignore_folders): continue
+                if '/__pycache__/' in filename: continue
+                if filename.startswith(".."):
+                    print("traversal to %s" % filename, file=sys.stderr)
+                filename = os.path.normpath(os.path.join(BASEDIR, filename))
+                modes = modes.split("|")
+                if 'O_DIRECTORY' in modes and 'O_RDONLY' in modes:
+                    readfolders.add(filename)
+                    continue
+                if 'O_RDWR' in modes:
+                    if filename not in writtenfiles:
+                        readfiles.add(filename)
+                        writtenfiles.add(filename)
+                    continue
+                if 'O_RDONLY' in modes:
                     readfiles.add(filename)
+                    continue
+                if 'O_WRONLY' in modes:
                     writtenfiles.add(filename)
-                continue
-            if 'O_RDONLY' in modes:
-                readfiles.add(filename)
-                continue
-            if 'O_WRONLY' in modes:
-                writtenfiles.add(filename)
-                continue
-            print("unexpected openat", allargs[1], modes, file=sys.stderr)
-        elif callname == 'chdir':
-            dirname = allargs[0].strip('"')
-            if dirname != BASEDIR:
-                print("unexpected chdir %s" % dirname, file=sys.stderr)
-        elif callname in (
-                'newfstatat', 'stat', 'access', 'getcwd', 'readlink',
-                'execve', 'unlink', 'utimensat',
-            ):
-            continue  # Ignoring these syscalls
-        else:
-            print("unknown call", callname, args)
-            time.sleep(0.05)
-    del stderr[:]
+                    continue
+                print("unexpected openat", filename, modes, file=sys.stderr)
+            elif callname == 'chdir':
+                dirname = allargs[0].strip('"')
+                if dirname != BASEDIR:
+                    print("unexpected chdir %s" % dirname, file=sys.stderr)
+            elif callname in (
+                    'newfstatat', 'stat', 'access', 'getcwd', 'readlink',
+                    'execve', 'unlink', 'utimensat',
+                ):
+                continue  # Ignoring these syscalls
+            else:
+                print("unknown call", callname, args)
+                time.sleep(0.05)
 
     print("%d files read, %d files written"
           % (len(readfiles), len(writtenfiles)))
@@ -146,11 +167,27 @@ def analyze_log():
              len(writtenfiles.difference(readfiles))))
     print("keeping those beginning with", BASEDIR)
 
+    # Most files share a few folders, so list each folder once
+    # instead of calling isfile() on each file
+    files_in_folder = {}
+    def isfile(s):
+        dirname, basename = os.path.split(s)
+        try:
+            names = files_in_folder[dirname]
+        except KeyError:
+            try:
+                with os.scandir(dirname) as it:
+                    names = {e.name for e in it if e.is_file()}
+            except OSError:
+                names = set()
+            files_in_folder[dirname] = names
+        return basename in names
+
     with open("zip-minimal.in", "w", encoding="utf-8") as outfp:
         outfp.writelines(
             s[len(BASEDIR) + 1:] + "\n"
             for s in sorted(readfiles.difference(writtenfiles))
-            if s.startswith(BASEDIR) and os.path.isfile(s)
+            if s.startswith(BASEDIR) and isfile(s)
         )
 
 if __name__=='__main__':